@@ -1,66 +1,588 @@
+import gzip
+import io
+import json
+import os
 import pandas as pd
+import numpy as np
 import re
 import random
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
 from itertools import chain
+from typing import Iterable, Iterator, Optional, Union
 from tqdm import tqdm
 
+VARIABLE_PATTERN = r"{{(.*?)}}"
+MANIFEST_NAME = "manifest.json"
+
+
+def parse_content(content: str) -> list[tuple[bool, str]]:
+    """
+    Split message content into (is_variable, text) segments, e.g.
+    "{{word}} ဆိုတာ" -> [(True, "word"), (False, " ဆိုတာ")].
+    """
+    parts = re.split(VARIABLE_PATTERN, content)
+    # re.split alternates literal text and captured variable names
+    return [(i % 2 == 1, part) for i, part in enumerate(parts) if part or i % 2 == 1]
+
+
+def empty_values(values: np.ndarray) -> np.ndarray:
+    """
+    Mask of the values that are present but falsy (e.g. empty strings), which
+    the generator does not fill templates with either.
+    """
+    empty = np.zeros(len(values), dtype=bool)
+    present = ~pd.isna(values)
+    empty[present] = ~values[present].astype(bool)
+    return empty
+
+
+class RejectionStats:
+    """
+    Rejected rows counted per (template group, variable, reason), with the
+    first max_rows row positions of each kept as examples.
+
+    A row is counted once per group, under the first variable it fails on.
+    Reasons are "missing_column", "missing_value" and "empty_value".
+    """
+
+    def __init__(self, max_rows: int = 10):
+        self.max_rows = max_rows
+        self.counts = Counter()
+        self.rows = defaultdict(list)
+
+    def add(self, group: int, variable: str, reason: str, rows: np.ndarray):
+        if not len(rows):
+            return
+        key = (group, variable, reason)
+        self.counts[key] += len(rows)
+        room = self.max_rows - len(self.rows[key])
+        if room > 0:
+            self.rows[key].extend(int(i) for i in rows[:room])
+
+    def update(self, other: "RejectionStats"):
+        for key, count in other.counts.items():
+            self.counts[key] += count
+            room = self.max_rows - len(self.rows[key])
+            self.rows[key].extend(other.rows[key][: max(room, 0)])
+
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+    def to_dict(self) -> list[dict]:
+        return [
+            {
+                "group": group,
+                "variable": variable,
+                "reason": reason,
+                "count": count,
+                "rows": self.rows[(group, variable, reason)],
+            }
+            for (group, variable, reason), count in sorted(self.counts.items())
+        ]
+
+    def summary(self) -> str:
+        lines = [f"Rejected {self.total()} records"]
+        for entry in self.to_dict():
+            lines.append(
+                f"  group {entry['group']} {entry['variable']}: {entry['reason']} "
+                f"x{entry['count']}, e.g. rows {entry['rows']}"
+            )
+        return "\n".join(lines)
+
+
+def splitmix64(x: np.ndarray) -> np.ndarray:
+    """
+    SplitMix64 finalizer, applied elementwise to uint64 values.
+    """
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def keyed_choices(seed: int, keys: np.ndarray, sizes: list[int]) -> np.ndarray:
+    """
+    Template index of every (row, template group), from a hash of (seed, row
+    key, group). A row's templates do not depend on which other rows are
+    generated with it, so any split of the input gives the same records.
+    """
+    seed_hash = splitmix64(np.array([seed % 2**64], dtype=np.uint64))
+    row_hash = splitmix64(keys.astype(np.uint64) ^ seed_hash)
+    choices = np.empty((len(keys), len(sizes)), dtype=np.int64)
+    for g, size in enumerate(sizes):
+        h = splitmix64(row_hash + np.uint64(g))
+        # The top 32 bits scaled to [0, size)
+        choices[:, g] = ((h >> np.uint64(32)) * np.uint64(size)) >> np.uint64(32)
+    return choices
+
+
+class ReproducibleGzipFile(gzip.GzipFile):
+    """
+    Gzip file written without a timestamp or file name in its header, so the
+    same content always compresses to the same bytes.
+    """
+
+    def __init__(self, path: str, mode: str = "wb"):
+        self._file = open(path, mode)
+        super().__init__(filename="", mode=mode, fileobj=self._file, mtime=0)
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._file.close()
+
+
+def open_text(path: str, mode: str = "r", buffer_size: int = 1 << 20):
+    """
+    Open a text file, compressed with gzip or zstd when the path ends with
+    ".gz" or ".zst". Compressed files are written reproducibly: the same
+    content always gives the same bytes.
+    """
+    if path.endswith(".gz"):
+        if mode == "r":
+            return gzip.open(path, "rt", encoding="utf-8")
+        return io.TextIOWrapper(ReproducibleGzipFile(path, mode + "b"), encoding="utf-8")
+    if path.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Writing .zst files requires `pip install zstandard`")
+        return zstandard.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8", buffering=buffer_size)
+
+
+def write_jsonl(path: str, records: Iterable[dict], buffer_size: int = 1 << 20) -> int:
+    """
+    Write records to a (possibly compressed, see open_text) JSONL file through a
+    buffer of buffer_size bytes, and return the number of records written.
+    """
+    count = 0
+    with open_text(path, "w", buffer_size) as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+def render(template: list[tuple[dict, Optional[list]]], values: dict) -> dict:
+    """
+    The record of one parsed template filled with a row's values.
+    """
+    return {
+        "messages": [
+            msg
+            if not segments
+            else {
+                **msg,
+                "content": "".join(
+                    values[text] if is_variable else text
+                    for is_variable, text in segments
+                ),
+            }
+            for msg, segments in template
+        ]
+    }
+
+
+def read_records(path: str) -> Iterator[dict]:
+    """
+    Read generated records back from a JSONL file (optionally .gz or .zst), a
+    compact Parquet file written by Generator.write_parquet, or a directory of
+    shards written by Generator.generate_sharded.
+    """
+    if os.path.isdir(path):
+        with open(os.path.join(path, MANIFEST_NAME), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        for shard in manifest["shards"]:
+            yield from read_records(os.path.join(path, shard["file"]))
+    elif path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path)
+        templates = json.loads(parquet_file.schema_arrow.metadata[b"templates"])
+        parsed = parse_templates(templates)
+        for batch in parquet_file.iter_batches():
+            for row in batch.to_pylist():
+                yield render(parsed[row["group"]][row["template"]], row)
+    else:
+        with open_text(path, "r") as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def parse_templates(templates: list[list[list[dict]]]) -> list:
+    # Every message of every template as (message, segments), segments is None
+    # for messages without content to fill
+    return [
+        [
+            [
+                (msg, parse_content(msg["content"]))
+                if "content" in msg and isinstance(msg["content"], str)
+                else (msg, None)
+                for msg in template
+            ]
+            for template in group
+        ]
+        for group in templates
+    ]
+
+
+def _write_shard(templates, dataframe, seed, key, first_row, path):
+    # Runs in a worker process of Generator.generate_sharded
+    generator = Generator(templates, dataframe, seed=seed, row_seeding=True, key=key)
+    records = generator.iter_records(first_row=first_row, progress=False)
+    return write_jsonl(path, records), generator.rejections
+
+
+class Columns:
+    """
+    Columns of one chunk of the input as object arrays, converted once.
+    """
+
+    def __init__(self, dataframe: pd.DataFrame):
+        self.dataframe = dataframe
+        self.values, self.missing, self.empty, self.strings = {}, {}, {}, {}
+
+    def __contains__(self, variable: str) -> bool:
+        return variable in self.dataframe.columns
+
+    def __len__(self) -> int:
+        return len(self.dataframe)
+
+    def get(self, variable: str) -> np.ndarray:
+        if variable not in self.values:
+            self.values[variable] = self.dataframe[variable].to_numpy(dtype=object)
+        return self.values[variable]
+
+    def get_missing(self, variable: str) -> np.ndarray:
+        if variable not in self.missing:
+            self.missing[variable] = pd.isna(self.get(variable))
+        return self.missing[variable]
+
+    def get_empty(self, variable: str) -> np.ndarray:
+        if variable not in self.empty:
+            self.empty[variable] = empty_values(self.get(variable))
+        return self.empty[variable]
+
+    def get_strings(self, variable: str) -> np.ndarray:
+        if variable not in self.strings:
+            values = self.get(variable)
+            if not pd.api.types.is_string_dtype(self.dataframe[variable]):
+                values = np.array([str(v) for v in values], dtype=object)
+            self.strings[variable] = values
+        return self.strings[variable]
+
 
 class Generator:
-    def __init__(self, templates: list[list[list[dict]]], dataframe: pd.DataFrame):
+    def __init__(
+        self,
+        templates: list[list[list[dict]]],
+        dataframe: Union[pd.DataFrame, Iterable[pd.DataFrame]],
+        seed: Optional[int] = None,
+        row_seeding: bool = False,
+        key: Optional[str] = None,
+    ):
         self.templates = templates
+        # A DataFrame, or an iterable of DataFrame chunks that is read once
         self.dataframe = dataframe
+        # Template choices are drawn from random.Random(seed), or from the global
+        # random module when no seed is given
+        self.rng = random if seed is None else random.Random(seed)
+        self.seed = seed
+        # With row_seeding, templates are chosen per row from (seed, row key)
+        # instead of one sequence for the whole input. The key is the value of
+        # the `key` column, or the row's position in the input
+        if row_seeding and seed is None:
+            raise ValueError("row_seeding requires a seed")
+        self.row_seeding = row_seeding
+        self.key = key
         self.association = []
-        self.logs = []
+        self.rejections = RejectionStats()
 
         for t in templates:
             combined_variables = chain.from_iterable(self.get_variables(e) for e in t)
             self.association.append((t, list(combined_variables)))
 
+        # Templates are parsed into literal/variable segments once
+        self.parsed = parse_templates(templates)
+        # Every variable, and the template groups that use it
+        self.variable_groups = {}
+        for g, (_, variables) in enumerate(self.association):
+            for variable in variables:
+                self.variable_groups.setdefault(variable, set()).add(g)
+
     def get_variables(self, template: list[dict]):
-        variables = set()
+        # In order of first appearance, so rejections are attributed the same
+        # way on every run
+        variables = {}
         for msg in template:
             if "content" in msg and isinstance(msg["content"], str):
                 # Find all variable patterns like {{var_name}} in the content
-                var_matches = re.findall(r"{{(.*?)}}", msg["content"])
+                var_matches = re.findall(VARIABLE_PATTERN, msg["content"])
                 for var_name in var_matches:
-                    variables.add(var_name)
-        return variables
-
-    def generate(self):
-        data = []
-        for _, row in tqdm(self.dataframe.iterrows(), total=len(self.dataframe)):
-            for templates, variables in self.association:
-                template = random.choice(templates)
-                is_valid = True
-                for variable in variables:
-                    if variable not in row:
-                        self.logs.append(f"Variable {variable} not found in row {row}")
-                        is_valid = False
-                        break
-
-                    value = row[variable]
-                    if not value or pd.isna(value):
-                        self.logs.append(
-                            f"Value {value} is not valid for variable {variable}"
-                        )
-                        is_valid = False
-                        break
-
-                    template = [
-                        {
-                            **t,
-                            "content": t["content"].replace(
-                                "{{" + variable + "}}", str(value)
-                            ),
-                        }
-                        for t in template
+                    variables[var_name] = None
+        return list(variables)
+
+    def choose_templates(self, num_rows: int) -> np.ndarray:
+        """
+        Template index of every (row, template group), drawn in the same order as
+        one random.choice per row and group.
+        """
+        ranges = [range(len(templates)) for templates, _ in self.association]
+        choice = self.rng.choice
+        draws = [choice(r) for _ in range(num_rows) for r in ranges]
+        return np.array(draws, dtype=np.int64).reshape(num_rows, len(ranges))
+
+    def _valid_rows(
+        self, columns: Columns, group: int, variables: list[str], first_row: int
+    ) -> np.ndarray:
+        """
+        Mask of the rows that have a value for every variable of a template
+        group, counting the others in self.rejections.
+        """
+        valid = np.ones(len(columns), dtype=bool)
+        for variable in dict.fromkeys(variables):
+            if variable not in columns:
+                reasons = [("missing_column", valid)]
+            else:
+                reasons = [
+                    ("missing_value", valid & columns.get_missing(variable)),
+                    ("empty_value", valid & columns.get_empty(variable)),
+                ]
+            for reason, rejected in reasons:
+                self.rejections.add(
+                    group, variable, reason, first_row + np.flatnonzero(rejected)
+                )
+            valid = valid & ~np.logical_or.reduce([r for _, r in reasons])
+        return valid
+
+    def _expand(self, columns: Columns, template, rows: np.ndarray) -> list[dict]:
+        """
+        Records of one template for the given rows, with every message's content
+        built column-wise from its segments.
+        """
+        if not len(rows):
+            return []
+        contents = []
+        for msg, segments in template:
+            if not segments or all(not is_variable for is_variable, _ in segments):
+                # Messages without variables are shared between records
+                contents.append(None)
+                continue
+            content = None
+            for is_variable, text in segments:
+                part = columns.get_strings(text)[rows] if is_variable else text
+                content = part if content is None else content + part
+            contents.append(content)
+
+        records = []
+        for i in range(len(rows)):
+            records.append(
+                {
+                    "messages": [
+                        msg if content is None else {**msg, "content": content[i]}
+                        for (msg, _), content in zip(template, contents)
                     ]
+                }
+            )
+        return records
 
-                if is_valid:
-                    data.append(
-                        {
-                            "messages": template,
-                        }
-                    )
-        print("\n".join(self.logs))
+    def row_keys(self, dataframe: pd.DataFrame, first_row: int) -> np.ndarray:
+        if self.key is not None:
+            return pd.util.hash_pandas_object(dataframe[self.key], index=False).to_numpy()
+        return np.arange(first_row, first_row + len(dataframe), dtype=np.uint64)
+
+    def _select(self, columns: Columns, first_row: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Template index of every (row, template group), and the mask of those
+        that produce a record.
+        """
+        if self.row_seeding:
+            sizes = [len(templates) for templates, _ in self.association]
+            choices = keyed_choices(
+                self.seed, self.row_keys(columns.dataframe, first_row), sizes
+            )
+        else:
+            choices = self.choose_templates(len(columns))
+        kept = np.zeros(choices.shape, dtype=bool)
+        for g, (_, variables) in enumerate(self.association):
+            kept[:, g] = self._valid_rows(columns, g, variables, first_row)
+        return choices, kept
+
+    def _generate_chunk(self, dataframe: pd.DataFrame, first_row: int = 0) -> list[dict]:
+        columns = Columns(dataframe)
+        choices, kept = self._select(columns, first_row)
+        records = np.empty(choices.shape, dtype=object)
+
+        for g, group in enumerate(self.parsed):
+            for t, template in enumerate(group):
+                rows = np.flatnonzero(kept[:, g] & (choices[:, g] == t))
+                expanded = np.empty(len(rows), dtype=object)
+                expanded[:] = self._expand(columns, template, rows)
+                records[rows, g] = expanded
+
+        return records[kept].tolist()
+
+    def _compact_chunk(self, dataframe: pd.DataFrame, first_row: int = 0) -> dict:
+        """
+        Records of a chunk as columns: input row, template group and template
+        index, and the value of every variable the group uses (None otherwise).
+        """
+        columns = Columns(dataframe)
+        choices, kept = self._select(columns, first_row)
+        rows, groups = np.nonzero(kept)
+        compact = {
+            "row": first_row + rows,
+            "group": groups,
+            "template": choices[rows, groups],
+        }
+        for variable, variable_groups in self.variable_groups.items():
+            values = np.full(len(rows), None, dtype=object)
+            used = np.isin(groups, list(variable_groups))
+            if variable in columns:
+                values[used] = columns.get_strings(variable)[rows[used]]
+            compact[variable] = values
+        return compact
+
+    def _chunks(self, chunk_size: int) -> Iterator[pd.DataFrame]:
+        if isinstance(self.dataframe, pd.DataFrame):
+            for start in range(0, len(self.dataframe), chunk_size):
+                yield self.dataframe.iloc[start : start + chunk_size]
+        else:
+            # Already chunked, e.g. pd.read_csv(..., chunksize=...)
+            yield from self.dataframe
+
+    def iter_records(
+        self, chunk_size: int = 10_000, first_row: int = 0, progress: bool = True
+    ) -> Iterator[dict]:
+        """
+        Yield records in row order, expanding chunk_size rows at a time so only
+        one chunk of records is in memory. first_row is the position of the
+        first row in the whole input, the default row key under row_seeding.
+        """
+        total = len(self.dataframe) if isinstance(self.dataframe, pd.DataFrame) else None
+        with tqdm(total=total, disable=not progress) as bar:
+            for chunk in self._chunks(chunk_size):
+                yield from self._generate_chunk(chunk, first_row)
+                first_row += len(chunk)
+                bar.update(len(chunk))
+
+    def generate(self, chunk_size: int = 10_000) -> list[dict]:
+        data = list(self.iter_records(chunk_size))
+        print(self.rejections.summary())
         return data
+
+    def write_jsonl(
+        self, path: str, chunk_size: int = 10_000, buffer_size: int = 1 << 20
+    ) -> int:
+        """
+        Stream the records to a JSONL file and return the number written.
+        """
+        count = write_jsonl(path, self.iter_records(chunk_size), buffer_size)
+        print(self.rejections.summary())
+        return count
+
+    def write_parquet(self, path: str, chunk_size: int = 10_000) -> int:
+        """
+        Write the records compactly to a Parquet file: one row per record with
+        its template group and index and the filled variables, dictionary
+        encoded and zstd compressed, and the templates stored once in the file
+        metadata. read_records expands the file back into records.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema(
+            [("row", pa.int64()), ("group", pa.int16()), ("template", pa.int16())]
+            + [(variable, pa.string()) for variable in self.variable_groups],
+            metadata={"templates": json.dumps(self.templates, ensure_ascii=False)},
+        )
+        count = 0
+        total = len(self.dataframe) if isinstance(self.dataframe, pd.DataFrame) else None
+        with pq.ParquetWriter(
+            path, schema, compression="zstd", use_dictionary=True
+        ) as writer, tqdm(total=total) as bar:
+            first_row = 0
+            for chunk in self._chunks(chunk_size):
+                compact = self._compact_chunk(chunk, first_row)
+                writer.write_table(pa.table(compact, schema=schema))
+                count += len(compact["row"])
+                first_row += len(chunk)
+                bar.update(len(chunk))
+        print(self.rejections.summary())
+        return count
+
+    def generate_sharded(
+        self,
+        directory: str,
+        num_workers: Optional[int] = None,
+        rows_per_shard: int = 50_000,
+        compression: Optional[str] = None,
+    ) -> dict:
+        """
+        Generate on a pool of num_workers processes, each writing the records of
+        rows_per_shard input rows to its own JSONL shard in `directory`, listed
+        in order in manifest.json.
+
+        Templates are chosen per row (see row_seeding), so the records of the
+        shards, read in manifest order, are identical however many workers or
+        shards are used, and identical to write_jsonl with row_seeding=True.
+        Shards are compressed with `compression`, "gzip" or "zstd"; the
+        compressed files themselves are byte-identical across runs with the
+        same rows_per_shard.
+        """
+        suffix = {None: "", "gzip": ".gz", "zstd": ".zst"}[compression]
+        if self.seed is None:
+            raise ValueError("Sharded generation requires a seed")
+        os.makedirs(directory, exist_ok=True)
+        num_workers = num_workers or os.cpu_count()
+        shards, pending = [], deque()
+        first_row = 0
+
+        def collect(future, shard):
+            num_records, rejections = future.result()
+            shard["num_records"] = num_records
+            self.rejections.update(rejections)
+
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            with tqdm(total=None, unit="shard") as bar:
+                for chunk in self._chunks(rows_per_shard):
+                    shard = {
+                        "file": f"shard-{len(shards):05d}.jsonl{suffix}",
+                        "first_row": first_row,
+                        "num_rows": len(chunk),
+                    }
+                    future = pool.submit(
+                        _write_shard,
+                        self.templates,
+                        chunk,
+                        self.seed,
+                        self.key,
+                        first_row,
+                        os.path.join(directory, shard["file"]),
+                    )
+                    shards.append(shard)
+                    pending.append((future, shard))
+                    first_row += len(chunk)
+                    # Bound the input chunks held in memory by queued shards
+                    while len(pending) > 2 * num_workers:
+                        collect(*pending.popleft())
+                        bar.update()
+                while pending:
+                    collect(*pending.popleft())
+                    bar.update()
+
+        manifest = {
+            "seed": self.seed,
+            "key": self.key,
+            "num_rows": first_row,
+            "num_records": sum(shard["num_records"] for shard in shards),
+            "shards": shards,
+            "rejections": self.rejections.to_dict(),
+        }
+        with open(os.path.join(directory, MANIFEST_NAME), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        print(self.rejections.summary())
+        return manifest
@@ -1,18 +1,25 @@
 from generate import Generator
 import pandas as pd
-import json
 import templates
 
-# header: alphabet,word,phonetics,meaning,pos,origin
-df = pd.read_csv("Burmese-Dictionary/burmese_dictionary.csv")
 
-# Ensure string type for relevant columns and handle potential NaN values
-df["word"] = df["word"].astype(str).fillna("")
-df["meaning"] = df["meaning"].astype(str).fillna("")
-df["phonetics"] = df["phonetics"].astype(str).fillna("")
-df["origin"] = df["origin"].astype(str).fillna("")
-# Add handling for the new 'alphabet' column
-df["alphabet"] = df["alphabet"].astype(str).fillna("")
+def prepare(df: pd.DataFrame) -> pd.DataFrame:
+    # Ensure string type for relevant columns and handle potential NaN values
+    df["word"] = df["word"].astype(str).fillna("")
+    df["meaning"] = df["meaning"].astype(str).fillna("")
+    df["phonetics"] = df["phonetics"].astype(str).fillna("")
+    df["origin"] = df["origin"].astype(str).fillna("")
+    # Add handling for the new 'alphabet' column
+    df["alphabet"] = df["alphabet"].astype(str).fillna("")
+    return df
+
+
+# header: alphabet,word,phonetics,meaning,pos,origin
+# Read in chunks, so memory does not grow with the size of the input
+chunks = (
+    prepare(df)
+    for df in pd.read_csv("Burmese-Dictionary/burmese_dictionary.csv", chunksize=50_000)
+)
 
 generator = Generator(
     [
@@ -49,16 +56,9 @@ generator = Generator(
             templates.pos_academic,
         ],
     ],
-    df,
+    chunks,
 )
-data = generator.generate()
-
-print(f"Finished generating")
-
-# with open("finetuning_data_2.jsonl", "w", encoding="utf-8") as f:
-# f.writelines(data)
+# Records are written as they are generated instead of being collected first
+count = generator.write_jsonl("finetuning_data_cleaned_2.jsonl")
 
-with open("finetuning_data_cleaned_2.jsonl", "w", encoding="utf-8") as f:
-    for obj in data:
-        line = json.dumps(obj, ensure_ascii=False)
-        f.write(line.strip() + "\n")
+print(f"Finished generating {count} records")
@@ -0,0 +1,124 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Awaitable, Callable, Optional
+
+
+class MicroBatcher:
+    """
+    Gathers concurrent calls into batches of up to max_batch_size items for
+    f_batch, which maps a list of items to a list of results.
+
+    There is no worker thread: the caller that fills a batch runs it, and a
+    caller still waiting after max_wait seconds runs whatever has been gathered
+    so far. Batches can only be as large as the number of concurrent callers.
+    """
+
+    def __init__(
+        self,
+        f_batch: Callable[[list[Any]], list[Any]],
+        max_batch_size: int,
+        max_wait: float = 0.1,
+    ):
+        self.f_batch = f_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending: list[tuple[Any, Future]] = []
+        self.lock = threading.Lock()
+
+    def _take(self, future: Optional[Future] = None) -> list[tuple[Any, Future]]:
+        # A full batch, or everything pending if it still includes `future`
+        with self.lock:
+            if len(self.pending) >= self.max_batch_size:
+                batch = self.pending[: self.max_batch_size]
+            elif future is not None and any(f is future for _, f in self.pending):
+                batch = self.pending
+            else:
+                return []
+            self.pending = self.pending[len(batch) :]
+            return batch
+
+    def _run(self, batch: list[tuple[Any, Future]]):
+        try:
+            results = self.f_batch([x for x, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(
+                    f"f_batch returned {len(results)} results for {len(batch)} items"
+                )
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def __call__(self, x):
+        future = Future()
+        with self.lock:
+            self.pending.append((x, future))
+        batch = self._take()
+        if batch:
+            self._run(batch)
+        try:
+            return future.result(timeout=self.max_wait)
+        except FutureTimeoutError:
+            batch = self._take(future)
+            if batch:
+                self._run(batch)
+            return future.result()
+
+
+class AsyncMicroBatcher:
+    """
+    Async version of MicroBatcher, for an async f_batch.
+    """
+
+    def __init__(
+        self,
+        f_batch: Callable[[list[Any]], Awaitable[list[Any]]],
+        max_batch_size: int,
+        max_wait: float = 0.1,
+    ):
+        self.f_batch = f_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending: list[tuple[Any, asyncio.Future]] = []
+
+    def _take(self, future: Optional[asyncio.Future] = None):
+        if len(self.pending) >= self.max_batch_size:
+            batch = self.pending[: self.max_batch_size]
+        elif future is not None and any(f is future for _, f in self.pending):
+            batch = self.pending
+        else:
+            return []
+        self.pending = self.pending[len(batch) :]
+        return batch
+
+    async def _run(self, batch: list[tuple[Any, asyncio.Future]]):
+        try:
+            results = await self.f_batch([x for x, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(
+                    f"f_batch returned {len(results)} results for {len(batch)} items"
+                )
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    async def __call__(self, x):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((x, future))
+        batch = self._take()
+        if batch:
+            await self._run(batch)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except asyncio.TimeoutError:
+            batch = self._take(future)
+            if batch:
+                await self._run(batch)
+            return await future
@@ -0,0 +1,86 @@
+import functools
+from typing import Any, Optional
+
+import numpy as np
+
+DEFAULT_RESAMPLES = 1000
+
+
+@functools.lru_cache(maxsize=16)
+def resample_weights(n: int, num_resamples: int = DEFAULT_RESAMPLES, seed: int = 0):
+    """
+    All bootstrap resamples of n examples at once, as a (num_resamples, n) matrix
+    of how often each example is drawn in each resample.
+
+    Cached, so every model and metric of a run shares the same resamples.
+    """
+    rng = np.random.default_rng(seed)
+    indices = rng.integers(0, n, size=(num_resamples, n))
+    # Offset each resample's indices so one bincount counts all rows at once
+    indices += np.arange(num_resamples)[:, None] * n
+    weights = np.bincount(indices.ravel(), minlength=num_resamples * n)
+    weights = weights.reshape(num_resamples, n).astype(float)
+    weights.flags.writeable = False
+    return weights
+
+
+def bootstrap_means(values: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """
+    Mean of every column of `values` (n examples x m metrics, NaN where an example
+    has no value for a metric) under every resample, as a (num_resamples, m) matrix.
+    """
+    present = ~np.isnan(values)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (weights @ np.where(present, values, 0.0)) / (weights @ present)
+
+
+def bootstrap_cis(
+    values: Any,
+    confidence: float = 0.95,
+    num_resamples: int = DEFAULT_RESAMPLES,
+    seed: int = 0,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Percentile bootstrap intervals for the mean of every column of `values`, from
+    one shared set of resamples.
+    """
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    means = bootstrap_means(values, resample_weights(len(values), num_resamples, seed))
+    alpha = (1 - confidence) / 2
+    # A resample can miss every example of a small category
+    means = np.where(np.isnan(means), np.nanmean(values, axis=0), means)
+    low, high = np.quantile(means, [alpha, 1 - alpha], axis=0)
+    return low, high
+
+
+def paired_bootstrap(
+    scores_a: Any,
+    scores_b: Any,
+    confidence: float = 0.95,
+    num_resamples: int = DEFAULT_RESAMPLES,
+    seed: int = 0,
+) -> Optional[dict[str, float]]:
+    """
+    Bootstrap the difference in mean score between two models evaluated on the
+    same examples, resampling the examples jointly so per-example difficulty
+    cancels out. Examples either model has no score for are dropped.
+    """
+    differences = np.asarray(scores_a, dtype=float) - np.asarray(scores_b, dtype=float)
+    differences = differences[~np.isnan(differences)]
+    if len(differences) == 0:
+        return None
+    weights = resample_weights(len(differences), num_resamples, seed)
+    resampled = weights @ differences / len(differences)
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(resampled, [alpha, 1 - alpha])
+    # Two-sided: how often the resampled difference lands on either side of zero
+    p_value = 2 * min(np.mean(resampled <= 0), np.mean(resampled >= 0))
+    return {
+        "difference": float(differences.mean()),
+        "ci_low": float(low),
+        "ci_high": float(high),
+        "p_value": float(min(p_value, 1.0)),
+        "num_examples": float(len(differences)),
+    }
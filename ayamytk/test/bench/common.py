@@ -1,7 +1,12 @@
+import asyncio
+import math
 import os
+import re
 from collections import defaultdict
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing.pool import ThreadPool
-from typing import Any, Optional, Callable
+from typing import Any, Awaitable, Optional, Callable
 
 import io
 import jinja2
@@ -9,7 +14,16 @@ import numpy as np
 import requests
 from tqdm import tqdm
 
-from ayamytk.test.bench.models import EvalResult, Message, SamplerBase, SingleEvalResult
+from ayamytk.test.bench.bootstrap import DEFAULT_RESAMPLES, bootstrap_cis
+from ayamytk.test.bench.early_stopping import EarlyStopping
+from ayamytk.test.bench.journal import EvalJournal
+from ayamytk.test.bench.models import (
+    EvalResult,
+    Message,
+    SamplerBase,
+    SamplerResponse,
+    SingleEvalResult,
+)
 
 EQUALITY_TEMPLATE = r"""
 Look at the following two expressions (answers to a math problem) and judge whether they are equivalent. Only perform trivial simplifications
@@ -101,28 +115,101 @@ def _compute_stat(values: list, stat: str):
         return np.min(values)
     elif stat == "max":
         return np.max(values)
+    elif stat == "sum":
+        return np.sum(values)
+    elif stat in ("p50", "p95", "p99"):
+        return np.percentile(values, float(stat[1:]))
     else:
         raise ValueError(f"Unknown {stat =}")
 
 
+# Default stats for the per-request metrics collected by sampler_metrics
+SAMPLER_STATS = {
+    "cache_hit": ("mean", "sum"),
+    "hedged": ("mean", "sum"),
+    "latency": ("mean", "p50", "p95", "p99", "max"),
+    "ttft": ("mean", "p50", "p95", "p99"),
+    "retries": ("mean", "sum"),
+    "prompt_tokens": ("mean", "sum"),
+    "completion_tokens": ("mean", "sum"),
+    "usage_estimated": ("mean", "sum"),
+    "batch_size": ("mean", "max"),
+}
+
+
+def sampler_metrics(response: SamplerResponse) -> dict[str, float]:
+    """
+    Per-request metrics reported by the sampler through its response metadata.
+    """
+    metadata = response.response_metadata or {}
+    metrics = {}
+    for name in SAMPLER_STATS:
+        if metadata.get(name) is not None:
+            metrics[name] = float(metadata[name])
+    return metrics
+
+
+def _throughput_metrics(single_eval_results: list[SingleEvalResult]) -> dict[str, float]:
+    """
+    Total tokens used, and completion tokens generated per second of request latency.
+    """
+    total_tokens = completion_tokens = latency = 0.0
+    for single_eval_result in single_eval_results:
+        metrics = single_eval_result.metrics
+        total_tokens += metrics.get("prompt_tokens", 0.0)
+        total_tokens += metrics.get("completion_tokens", 0.0)
+        if "completion_tokens" in metrics and "latency" in metrics:
+            completion_tokens += metrics["completion_tokens"]
+            latency += metrics["latency"]
+    throughput = {}
+    if total_tokens:
+        throughput["total_tokens"] = total_tokens
+    if latency:
+        throughput["tokens_per_sec"] = completion_tokens / latency
+    return throughput
+
+
+def _confidence_intervals(
+    single_eval_results: list[SingleEvalResult],
+    names: list[str],
+    num_resamples: int,
+) -> dict[str, float]:
+    """
+    Bootstrap intervals for the score and every per-category metric, all from
+    one set of resamples.
+    """
+    values = np.full((len(single_eval_results), len(names)), np.nan)
+    for i, single_eval_result in enumerate(single_eval_results):
+        row = {**single_eval_result.metrics, "score": single_eval_result.score}
+        for j, name in enumerate(names):
+            if row.get(name) is not None:
+                values[i, j] = row[name]
+    low, high = bootstrap_cis(values, num_resamples=num_resamples)
+    intervals = {}
+    for j, name in enumerate(names):
+        intervals[f"{name}:ci_low"] = float(low[j])
+        intervals[f"{name}:ci_high"] = float(high[j])
+    return intervals
+
+
 def aggregate_results(
     single_eval_results: list[SingleEvalResult],
     default_stats: tuple[str, str] = ("mean", "std"),
     name2stats: Optional[dict[str, tuple[str]]] = None,
+    num_resamples: int = DEFAULT_RESAMPLES,
 ) -> EvalResult:
     """
     Aggregate results from multiple evaluations into a single EvalResult.
+    Set num_resamples to 0 to skip the bootstrap confidence intervals.
     """
-    name2stats = name2stats or {}
+    name2stats = {**SAMPLER_STATS, **(name2stats or {})}
     name2values = defaultdict(list)
-    htmls = []
     convos = []
     for single_eval_result in single_eval_results:
         for name, value in single_eval_result.metrics.items():
             name2values[name].append(value)
         if single_eval_result.score is not None:
             name2values["score"].append(single_eval_result.score)
-        htmls.append(single_eval_result.html)
         convos.append(single_eval_result.convo)
     final_metrics = {}
     for name, values in name2values.items():
@@ -130,18 +217,45 @@ def aggregate_results(
         for stat in stats:
             key = name if stat == "mean" else f"{name}:{stat}"
             final_metrics[key] = _compute_stat(values, stat)
+    final_metrics.update(_throughput_metrics(single_eval_results))
+    if num_resamples and single_eval_results:
+        # Request metrics (latency, tokens, ...) describe the run, not the model
+        names = [name for name in name2values if name not in SAMPLER_STATS]
+        final_metrics.update(
+            _confidence_intervals(single_eval_results, names, num_resamples)
+        )
     return EvalResult(
         score=final_metrics.pop("score", None),
         metrics=final_metrics,
-        htmls=htmls,
+        htmls=ExampleHtmls(single_eval_results),
         convos=convos,
+        scores=[result.score for result in single_eval_results],
     )
 
 
-def map_with_progress(f: Callable, xs: list[Any], num_threads: int = 50):
+def map_with_progress(
+    f: Callable,
+    xs: list[Any],
+    num_threads: int = 50,
+    journal: Optional[EvalJournal] = None,
+):
     """
     Apply f to each element of xs, using a ThreadPool, and show progress.
+    With a journal, elements that already have a result are skipped and each
+    new result is checkpointed as soon as it completes.
     """
+    if journal is not None:
+        pending = journal.pending(xs)
+
+        def journaled(x):
+            result = f(x)
+            journal.record(x, result)
+            return result
+
+        if pending:
+            map_with_progress(journaled, pending, num_threads=num_threads)
+        return journal.results(xs)
+
     if os.getenv("debug"):
         return list(map(f, tqdm(xs, total=len(xs))))
     else:
@@ -149,11 +263,185 @@ def map_with_progress(f: Callable, xs: list[Any], num_threads: int = 50):
             return list(tqdm(pool.imap(f, xs), total=len(xs)))
 
 
+async def amap_with_progress(
+    f: Callable[[Any], Awaitable[Any]],
+    xs: list[Any],
+    max_concurrency: int = 1000,
+    journal: Optional[EvalJournal] = None,
+):
+    """
+    Await f on each element of xs from the running event loop, keeping at most
+    max_concurrency calls in flight, and show progress. Results keep the order of xs.
+    """
+    if journal is not None:
+        pending = journal.pending(xs)
+
+        async def journaled(x):
+            result = await f(x)
+            journal.record(x, result)
+            return result
+
+        if pending:
+            await amap_with_progress(
+                journaled, pending, max_concurrency=max_concurrency
+            )
+        return journal.results(xs)
+
+    if os.getenv("debug"):
+        max_concurrency = 1
+    semaphore = asyncio.Semaphore(max_concurrency)
+    pbar = tqdm(total=len(xs))
+
+    async def run(x):
+        async with semaphore:
+            result = await f(x)
+        pbar.update(1)
+        return result
+
+    try:
+        return await asyncio.gather(*(run(x) for x in xs))
+    finally:
+        pbar.close()
+
+
+def map_pipeline(
+    f: Callable,
+    g: Callable,
+    xs: list[Any],
+    num_threads: int = 50,
+    g_threads: int = 10,
+    journal: Optional[EvalJournal] = None,
+):
+    """
+    Apply f to each element of xs on num_threads threads, then g(x, f(x)) on a
+    separate pool of g_threads threads. A slow second stage (e.g. grading) does
+    not hold a first-stage thread, so f keeps running on the next elements.
+    """
+    if journal is not None:
+        pending = journal.pending(xs)
+    else:
+        pending = xs
+    with ThreadPoolExecutor(max_workers=g_threads) as second_stage:
+
+        def staged(x):
+            future = second_stage.submit(g, x, f(x))
+            if journal is not None:
+                future.add_done_callback(
+                    lambda done: done.exception() or journal.record(x, done.result())
+                )
+            return future
+
+        futures = []
+        if pending:
+            futures = map_with_progress(staged, pending, num_threads=num_threads)
+        results = [future.result() for future in futures]
+    return journal.results(xs) if journal is not None else results
+
+
+async def amap_pipeline(
+    f: Callable[[Any], Awaitable[Any]],
+    g: Callable[[Any, Any], Awaitable[Any]],
+    xs: list[Any],
+    max_concurrency: int = 1000,
+    g_concurrency: int = 10,
+    journal: Optional[EvalJournal] = None,
+):
+    """
+    Async version of map_pipeline: at most max_concurrency calls of f and
+    g_concurrency calls of g are in flight, each stage with its own limit.
+    """
+    first_stage = asyncio.Semaphore(max_concurrency)
+    second_stage = asyncio.Semaphore(g_concurrency)
+
+    async def staged(x):
+        # The first stage's slot is released as soon as f is done
+        async with first_stage:
+            y = await f(x)
+        async with second_stage:
+            return await g(x, y)
+
+    # Concurrency is limited per stage by the semaphores above
+    return await amap_with_progress(
+        staged, xs, max_concurrency=max(len(xs), 1), journal=journal
+    )
+
+
+def _scores(results: list[SingleEvalResult]) -> list[float]:
+    return [result.score for result in results if result.score is not None]
+
+
+def map_until_stopped(
+    map_batch: Callable[[list[Any]], list[SingleEvalResult]],
+    xs: list[Any],
+    early_stopping: EarlyStopping,
+) -> list[SingleEvalResult]:
+    """
+    Map xs in order, one batch at a time with map_batch (e.g. map_with_progress),
+    until the scores so far meet the early stopping rule. Returns the results of
+    the examples that were run.
+    """
+    results = []
+    for start in range(0, len(xs), early_stopping.batch_size):
+        results += map_batch(xs[start : start + early_stopping.batch_size])
+        if early_stopping.should_stop(_scores(results)):
+            break
+    return results
+
+
+async def amap_until_stopped(
+    map_batch: Callable[[list[Any]], Awaitable[list[SingleEvalResult]]],
+    xs: list[Any],
+    early_stopping: EarlyStopping,
+) -> list[SingleEvalResult]:
+    """
+    Async version of map_until_stopped.
+    """
+    results = []
+    for start in range(0, len(xs), early_stopping.batch_size):
+        results += await map_batch(xs[start : start + early_stopping.batch_size])
+        if early_stopping.should_stop(_scores(results)):
+            break
+    return results
+
+
+def early_stopping_metrics(
+    results: list[SingleEvalResult], early_stopping: EarlyStopping, num_available: int
+) -> dict[str, float]:
+    return early_stopping.metrics(_scores(results), num_available)
+
+
+# Named templates, each parsed and compiled once per process by jinja_env
+TEMPLATES: dict[str, str] = {}
+
 jinja_env = jinja2.Environment(
-    loader=jinja2.BaseLoader(),
+    loader=jinja2.DictLoader(TEMPLATES),
     undefined=jinja2.StrictUndefined,
     autoescape=jinja2.select_autoescape(["html", "xml"]),
 )
+
+
+def register_template(name: str, source: str):
+    """
+    Add a template to the registry. Names need an .html extension to be autoescaped.
+    """
+    TEMPLATES[name] = source
+
+
+def get_template(name: str) -> jinja2.Template:
+    """
+    Compiled template from the registry, compiled on first use only.
+    """
+    return jinja_env.get_template(name)
+
+
+def enable_template_cache(directory: str = "./output/cache/jinja"):
+    """
+    Keep compiled templates on disk, so new processes skip compilation too.
+    """
+    os.makedirs(directory, exist_ok=True)
+    jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache(directory)
+
+
 _message_template = """
 <div class="message {{ role }}">
     <div class="role">
@@ -171,7 +459,7 @@ def message_to_html(message: Message) -> str:
     """
     Generate HTML snippet (inside a <div>) for a message.
     """
-    return jinja_env.from_string(_message_template).render(
+    return get_template("message.html").render(
         role=message["role"],
         content=message["content"],
         variant=message.get("variant", None),
@@ -179,11 +467,14 @@ def message_to_html(message: Message) -> str:
 
 
 jinja_env.globals["message_to_html"] = message_to_html
+register_template("message.html", _message_template)
+register_template("example.html", HTML_JINJA)
 
 
-_report_template = """<!DOCTYPE html>
+_report_head = """<!DOCTYPE html>
 <html>
     <head>
+        <meta charset="utf-8">
         <style>
             .message {
                 padding: 8px 16px;
@@ -217,7 +508,9 @@ _report_template = """<!DOCTYPE html>
             }
         </style>
     </head>
-    <body>
+"""
+
+_metrics_table = """
     {% if metrics %}
     <h1>Metrics</h1>
     <table>
@@ -237,7 +530,13 @@ _report_template = """<!DOCTYPE html>
     {% endfor %}
     </table>
     {% endif %}
-    <h1>Examples</h1>
+"""
+
+_report_template = (
+    _report_head
+    + """    <body>"""
+    + _metrics_table
+    + """    <h1>Examples</h1>
     {% for html in htmls %}
     {{ html | safe }}
     <hr>
@@ -245,13 +544,149 @@ _report_template = """<!DOCTYPE html>
     </body>
 </html>
 """
+)
+
+_index_template = (
+    _report_head
+    + """    <body>"""
+    + _metrics_table
+    + """    <h1>Examples</h1>
+    <p>{{ num_examples }} examples</p>
+    <table>
+    <tr>
+        <th>Page</th>
+        <th>Examples</th>
+        <th>Score</th>
+    </tr>
+    {% for page in pages %}
+    <tr>
+        <td><a href="{{ page.href }}">{{ loop.index }}</a></td>
+        <td>{{ page.start }}-{{ page.stop }}</td>
+        <td>{% if page.score is not none %}{{ page.score | round(3) }}{% endif %}</td>
+    </tr>
+    {% endfor %}
+    </table>
+    </body>
+</html>
+"""
+)
+
+_page_template = (
+    _report_head
+    + """    <body>
+    <p>
+    <a href="{{ index_href }}">Index</a>
+    {% if prev_href %}<a href="{{ prev_href }}">Previous</a>{% endif %}
+    {% if next_href %}<a href="{{ next_href }}">Next</a>{% endif %}
+    Page {{ page }} of {{ num_pages }}
+    </p>
+    <h1>Examples {{ start }}-{{ stop }}</h1>
+    {% for html in htmls %}
+    {{ html | safe }}
+    <hr>
+    {% endfor %}
+    </body>
+</html>
+"""
+)
+
+
+def example_html(single_eval_result: SingleEvalResult) -> Optional[str]:
+    """
+    HTML snippet of a single example, rendered from its report fields unless the
+    eval rendered it already.
+    """
+    if single_eval_result.html is not None or single_eval_result.report_fields is None:
+        return single_eval_result.html
+    convo = single_eval_result.convo
+    return get_template("example.html").render(
+        prompt_messages=convo[:-1],
+        next_message=convo[-1],
+        score=single_eval_result.score,
+        **single_eval_result.report_fields,
+    )
+
+
+class ExampleHtmls(Sequence):
+    """
+    Per-example HTML of an EvalResult, rendered when accessed instead of being
+    kept in memory for the whole run.
+    """
+
+    def __init__(self, single_eval_results: list[SingleEvalResult]):
+        self.single_eval_results = single_eval_results
+
+    def __len__(self) -> int:
+        return len(self.single_eval_results)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [example_html(r) for r in self.single_eval_results[index]]
+        return example_html(self.single_eval_results[index])
+
+
+register_template("report.html", _report_template)
+register_template("report_index.html", _index_template)
+register_template("report_page.html", _page_template)
+
+
+def _stream_template(name: str, path: str, **context: Any):
+    with open(path, "w", encoding="utf-8") as fh:
+        fh.writelines(get_template(name).generate(**context))
+
+
+def write_report(eval_result: EvalResult, path: str, page_size: int = 100) -> list[str]:
+    """
+    Stream an HTML report to disk, one example at a time. `path` gets an index
+    page with the metrics and a link to every page of `page_size` examples, which
+    are written next to it as `<name>_page<n>.html`. Returns the files written.
+    """
+    stem, ext = os.path.splitext(path)
+    htmls = eval_result.htmls or []
+    scores = eval_result.scores or []
+    num_pages = max(1, math.ceil(len(htmls) / page_size))
+    page_paths = [f"{stem}_page{i + 1}{ext}" for i in range(num_pages)]
+    pages = []
+    for i, page_path in enumerate(page_paths):
+        start, stop = i * page_size, min((i + 1) * page_size, len(htmls))
+        page_scores = [x for x in scores[start:stop] if x is not None]
+        pages.append(
+            dict(
+                href=os.path.basename(page_path),
+                start=start + 1,
+                stop=stop,
+                score=float(np.mean(page_scores)) if page_scores else None,
+            )
+        )
+    _stream_template(
+        "report_index.html",
+        path,
+        score=eval_result.score,
+        metrics=eval_result.metrics,
+        num_examples=len(htmls),
+        pages=pages,
+    )
+    for i, (page_path, page) in enumerate(zip(page_paths, pages)):
+        _stream_template(
+            "report_page.html",
+            page_path,
+            htmls=(htmls[j] for j in range(page["start"] - 1, page["stop"])),
+            index_href=os.path.basename(path),
+            prev_href=pages[i - 1]["href"] if i > 0 else None,
+            next_href=pages[i + 1]["href"] if i + 1 < num_pages else None,
+            page=i + 1,
+            num_pages=num_pages,
+            start=page["start"],
+            stop=page["stop"],
+        )
+    return [path] + page_paths
 
 
 def make_report(eval_result: EvalResult) -> str:
     """
     Create a standalone HTML report from an EvalResult.
     """
-    return jinja_env.from_string(_report_template).render(
+    return get_template("report.html").render(
         score=eval_result.score,
         metrics=eval_result.metrics,
         htmls=eval_result.htmls,
@@ -262,7 +697,7 @@ def make_report_from_example_htmls(htmls: list[str]):
     """
     Create a standalone HTML report from a list of example htmls
     """
-    return jinja_env.from_string(_report_template).render(
+    return get_template("report.html").render(
         score=None, metrics={}, htmls=htmls
     )
 
@@ -301,6 +736,101 @@ def normalize_extracted_answer(extracted_answer: str) -> str:
     )
 
 
+LOGPROB_ANSWER_PREFIX = "အဖြေ:"
+# Tokens allowed before the answer itself, such as a space or an opening bracket
+LOGPROB_LEADING_TOKENS = 2
+
+
+def logprob_options(choices: list[str]) -> dict[str, Any]:
+    """
+    Generation settings for scoring `choices` from next-token logprobs instead of
+    a chain-of-thought response. Burmese letters are often split into byte-level
+    tokens, so enough tokens are generated to spell out the longest choice one
+    byte at a time, which always reaches the first byte where the choices differ.
+    """
+    longest = max(len(choice.encode("utf-8")) for choice in choices)
+    return dict(
+        max_tokens=longest + LOGPROB_LEADING_TOKENS, logprobs=20, temperature=0.0
+    )
+
+
+def check_logprob_support(sampler):
+    """
+    Raise a ValueError if a (possibly wrapped) sampler cannot return logprobs.
+    """
+    inner = sampler
+    while hasattr(inner, "sampler"):
+        inner = inner.sampler
+    if not hasattr(inner, "logprobs"):
+        raise ValueError(
+            f"{type(inner).__name__} does not return logprobs, "
+            'use scoring="reasoning" instead of scoring="logprob"'
+        )
+
+
+def _token_bytes(token: dict) -> bytes:
+    if token.get("bytes") is not None:
+        return bytes(token["bytes"])
+    return token["token"].encode("utf-8")
+
+
+def choice_logprob(logprobs: list[dict], choice: str) -> Optional[float]:
+    """
+    Log probability that a completion starts with `choice`, from its per-token
+    top logprobs. The choice is followed token by token along the sampled path,
+    skipping leading whitespace or brackets. If the completion ends part way
+    through the choice, the log probability of the part generated so far is
+    returned. Returns None if the choice never appears.
+    """
+    encoded = target = choice.encode("utf-8")
+    total = 0.0
+    for position in logprobs:
+        alternatives = [
+            (_token_bytes(t), t["logprob"]) for t in position.get("top_logprobs") or []
+        ] or [(_token_bytes(position), position["logprob"])]
+        for token, logprob in alternatives:
+            if token == target:
+                return total + logprob
+        sampled = _token_bytes(position)
+        if sampled and target.startswith(sampled):
+            total += position["logprob"]
+            target = target[len(sampled) :]
+            continue
+        if target == encoded and not sampled.strip(b" \t\n(:"):
+            continue
+        # The choice diverges from the sampled path, so only its first token's
+        # probability is known
+        partial = [lp for token, lp in alternatives if token and target.startswith(token)]
+        return total + max(partial) if partial else None
+    return total if target != encoded else None
+
+
+def pick_choice(logprobs: list[dict], choices: list[str]) -> Optional[str]:
+    """
+    The most likely of `choices` according to `choice_logprob`, if any appears.
+    Returns None when the completion ended before the leading choices diverged.
+    """
+    scored = [(choice_logprob(logprobs, c), c) for c in choices]
+    scored = sorted(((lp, c) for lp, c in scored if lp is not None), reverse=True)
+    if not scored or (len(scored) > 1 and scored[0][0] == scored[1][0]):
+        return None
+    return scored[0][1]
+
+
+def text_choice(text: str, choices: list[str]) -> Optional[str]:
+    """
+    The first of `choices` found in a generated text, for when logprobs do not
+    decide. A text that ends part way through an answer is matched if it is the
+    start of exactly one choice.
+    """
+    match = re.search("|".join(re.escape(c) for c in choices), text)
+    if match:
+        return match.group(0)
+    stripped = text.strip(" \t\n(:")
+    started = [c for c in choices if stripped and c.startswith(stripped)]
+    return started[0] if len(started) == 1 else None
+
+
 def url_to_fileobj(url: str, binary=False) -> Any:
     response = requests.get(url)
     response.raise_for_status()
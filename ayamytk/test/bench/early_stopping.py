@@ -0,0 +1,85 @@
+import math
+from statistics import NormalDist
+from typing import Optional
+
+from ayamytk.test.bench.bootstrap import bootstrap_cis
+
+
+def wilson_interval(successes: float, n: int, z: float = 1.96) -> tuple[float, float]:
+    """
+    Wilson score interval for a binomial proportion.
+    """
+    if n == 0:
+        return 0.0, 1.0
+    p = successes / n
+    denominator = 1 + z**2 / n
+    center = (p + z**2 / (2 * n)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / n + z**2 / (4 * n**2)) / denominator
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+def bootstrap_interval(
+    scores: list[float], confidence: float = 0.95
+) -> tuple[float, float]:
+    """
+    Percentile bootstrap interval for the mean score.
+    """
+    low, high = bootstrap_cis(scores, confidence)
+    return float(low[0]), float(high[0])
+
+
+class EarlyStopping:
+    """
+    Stopping rule for evaluating examples sequentially, in a seeded random order.
+
+    Stops once the confidence interval on the mean score is narrower than
+    `ci_width`, or once it no longer contains `reference_score` (the model is
+    clearly better or worse than the reference). Scores that are all 0 or 1 use a
+    Wilson interval, other scores a bootstrap interval. Nothing is decided before
+    `min_examples` examples have been scored.
+    """
+
+    def __init__(
+        self,
+        ci_width: Optional[float] = 0.1,
+        reference_score: Optional[float] = None,
+        confidence: float = 0.95,
+        min_examples: int = 30,
+        batch_size: int = 50,
+    ):
+        if ci_width is None and reference_score is None:
+            raise ValueError("Either ci_width or reference_score must be set")
+        self.ci_width = ci_width
+        self.reference_score = reference_score
+        self.confidence = confidence
+        self.min_examples = min_examples
+        # Examples evaluated concurrently between two checks of the rule
+        self.batch_size = batch_size
+
+    def interval(self, scores: list[float]) -> tuple[float, float]:
+        if all(score in (0.0, 1.0) for score in scores):
+            z = NormalDist().inv_cdf(0.5 + self.confidence / 2)
+            return wilson_interval(sum(scores), len(scores), z)
+        return bootstrap_interval(scores, self.confidence)
+
+    def should_stop(self, scores: list[float]) -> bool:
+        if len(scores) < self.min_examples:
+            return False
+        low, high = self.interval(scores)
+        if self.ci_width is not None and high - low <= self.ci_width:
+            return True
+        if self.reference_score is not None and not low <= self.reference_score <= high:
+            return True
+        return False
+
+    def metrics(self, scores: list[float], num_available: int) -> dict[str, float]:
+        """
+        How many examples were used, and the interval the rule was checked on.
+        """
+        low, high = self.interval(scores) if scores else (0.0, 1.0)
+        return {
+            "num_examples": float(len(scores)),
+            "stopped_early": float(len(scores) < num_available),
+            "score:stopping_ci_low": low,
+            "score:stopping_ci_high": high,
+        }
@@ -1,43 +1,54 @@
+import asyncio
+import functools
+import itertools
 import json
 import os
 import argparse
-import pandas as pd
+from typing import Optional
 
 import sys
 
 sys.path.append(os.path.abspath("."))
 
-from ayamytk.test.bench import common
-from ayamytk.test.bench.mmlu_eval import MMLUEval
-from ayamytk.test.bench.exam_eval import ExamEval
-from ayamytk.test.bench.sampler import OpenRouterSampler
+# Only lightweight modules are imported here, so that the CLI starts quickly.
+# Provider SDKs, datasets, numpy and pandas are imported once they are needed.
+import ayamytk.test.bench.sampler as bench_sampler
+from ayamytk.test.bench.journal import EvalJournal
+from ayamytk.test.bench.models import with_supported_options
+from ayamytk.test.bench.registry import LazyRegistry
+from ayamytk.test.bench.scheduler import Scheduler
+from ayamytk.test.bench.sampler.cached_sampler import OPTIONAL_KEY_FIELDS, with_cache
+from ayamytk.test.bench.sampler.hedged_sampler import with_hedging
 
 
 evals_default = "mmlu_lite,mg12l"
 models_default = "all"
 language_default = "MYA"
 
-MODELS = {
-    # "deepseek-chat": OpenRouterSampler(model="deepseek/deepseek-chat"),
-    # "gemini-2.0-flash": OpenRouterSampler(
-    #     model="google/gemini-2.0-flash-001"
-    # ),
-    # "gemma-3-4b-it": OpenRouterSampler(model="google/gemma-3-4b-it"),
-    # "gemma-3-12b-it": OpenRouterSampler(model="google/gemma-3-12b-it"),
-    # "gemma-3-27b-it": OpenRouterSampler(model="google/gemma-3-27b-it"),
-    # "aya-8b": CohereSampler(model="c4ai-aya-expanse-8b"),
-    # "aya-32b": CohereSampler(model="c4ai-aya-expanse-32b"),
-    # "command-r7b": CohereSampler(model="command-r7b-12-2024"),
-    # "command-r": CohereSampler(model="command-r-08-2024"),
-    # "command-a": CohereSampler(model="command-a-03-2025"),
-    # "gpt-4o": ChatCompletionSampler(model="gpt-4o"),
-    # "claude-3.7-sonnet": OpenRouterSampler(
-    #     model="anthropic/claude-3.7-sonnet"
-    # ),
-    # "claude-3-haiku": OpenRouterSampler(model="anthropic/claude-3-haiku"),
-    # "qwen-2.5-7b": OpenRouterSampler(model="qwen/qwen-2.5-7b-instruct"),
-    # "qwen-2.5-72b": OpenRouterSampler(model="qwen/qwen-2.5-72b-instruct"),
-}
+# Samplers are only constructed when a model is selected
+MODELS = LazyRegistry(
+    {
+        # "deepseek-chat": lambda: bench_sampler.OpenRouterSampler(model="deepseek/deepseek-chat"),
+        # "gemini-2.0-flash": lambda: bench_sampler.OpenRouterSampler(
+        #     model="google/gemini-2.0-flash-001"
+        # ),
+        # "gemma-3-4b-it": lambda: bench_sampler.OpenRouterSampler(model="google/gemma-3-4b-it"),
+        # "gemma-3-12b-it": lambda: bench_sampler.OpenRouterSampler(model="google/gemma-3-12b-it"),
+        # "gemma-3-27b-it": lambda: bench_sampler.OpenRouterSampler(model="google/gemma-3-27b-it"),
+        # "aya-8b": lambda: bench_sampler.CohereSampler(model="c4ai-aya-expanse-8b"),
+        # "aya-32b": lambda: bench_sampler.CohereSampler(model="c4ai-aya-expanse-32b"),
+        # "command-r7b": lambda: bench_sampler.CohereSampler(model="command-r7b-12-2024"),
+        # "command-r": lambda: bench_sampler.CohereSampler(model="command-r-08-2024"),
+        # "command-a": lambda: bench_sampler.CohereSampler(model="command-a-03-2025"),
+        # "gpt-4o": lambda: bench_sampler.ChatCompletionSampler(model="gpt-4o"),
+        # "claude-3.7-sonnet": lambda: bench_sampler.OpenRouterSampler(
+        #     model="anthropic/claude-3.7-sonnet"
+        # ),
+        # "claude-3-haiku": lambda: bench_sampler.OpenRouterSampler(model="anthropic/claude-3-haiku"),
+        # "qwen-2.5-7b": lambda: bench_sampler.OpenRouterSampler(model="qwen/qwen-2.5-7b-instruct"),
+        # "qwen-2.5-72b": lambda: bench_sampler.OpenRouterSampler(model="qwen/qwen-2.5-72b-instruct"),
+    }
+)
 
 
 def main():
@@ -68,6 +79,88 @@ def main():
         help="Comma-separated list of evaluations to run (e.g., 'mmlu_lite,mg12l')",
         default=evals_default,
     )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        help="Path to a SQLite response cache shared across runs",
+        default=None,
+    )
+    parser.add_argument(
+        "--cache-read-only",
+        action="store_true",
+        help="Read from the response cache without writing new responses",
+    )
+    parser.add_argument(
+        "--scoring",
+        choices=["reasoning", "logprob"],
+        help="Score multiple choice questions from chain-of-thought answers or from next-token logprobs",
+        default="reasoning",
+    )
+    parser.add_argument(
+        "--no-stop-at-answer",
+        action="store_true",
+        help="Let models finish their response instead of stopping generation at the answer line",
+    )
+    parser.add_argument(
+        "--generation-budget",
+        type=str,
+        action="append",
+        help="Max tokens to generate per question type, as TYPE=TOKENS (e.g. MCQ=512); repeatable",
+        default=None,
+    )
+    parser.add_argument(
+        "--hedge-percentile",
+        type=float,
+        help="Send a duplicate of requests that run past this latency percentile (e.g. 95)",
+        default=None,
+    )
+    parser.add_argument(
+        "--request-timeout",
+        type=float,
+        help="Seconds before a single request is abandoned and retried, for samplers that support it",
+        default=None,
+    )
+    parser.add_argument(
+        "--ci-width",
+        type=float,
+        help="Stop an eval early once the confidence interval on its score is this narrow",
+        default=None,
+    )
+    parser.add_argument(
+        "--reference-score",
+        type=float,
+        help="Stop an eval early once its score is clearly above or below this one",
+        default=None,
+    )
+    parser.add_argument(
+        "--snapshot",
+        type=str,
+        help="Load the benchmarks from a local snapshot directory instead of the Hugging Face hub",
+        default=None,
+    )
+    parser.add_argument(
+        "--grader-concurrency",
+        type=int,
+        help="Grader requests in flight per eval, independent of sampling concurrency",
+        default=20,
+    )
+    parser.add_argument(
+        "--grader-batch-size",
+        type=int,
+        help="Short answers graded per grader request (1 grades each answer on its own)",
+        default=1,
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        help="Threads shared by all synchronous samplers across every model and eval",
+        default=200,
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="Discard the checkpoint journal of a previous run and sample every example again",
+    )
 
     args = parser.parse_args()
 
@@ -97,9 +190,91 @@ def main():
         evals=args.evals,
         samplers=models,
         language=args.language,
+        cache_path=args.cache,
+        cache_read_only=args.cache_read_only,
+        resume=not args.no_resume,
+        max_workers=args.max_workers,
+        scoring=args.scoring,
+        stop_at_answer=not args.no_stop_at_answer,
+        generation_budgets=parse_generation_budgets(args.generation_budget),
+        hedge_percentile=args.hedge_percentile,
+        request_timeout=args.request_timeout,
+        ci_width=args.ci_width,
+        reference_score=args.reference_score,
+        snapshot=args.snapshot,
+        grader_concurrency=args.grader_concurrency,
+        grader_batch_size=args.grader_batch_size,
     )
 
 
+class EvalRunError(Exception):
+    """
+    Raised by run when some (model, eval) pairs failed; `failures` lists each
+    pair's model name, eval name and exception.
+    """
+
+    def __init__(self, failures: list[tuple[str, str, BaseException]]):
+        self.failures = failures
+        super().__init__(
+            f"{len(failures)} (model, eval) pair(s) failed: "
+            + ", ".join(
+                f"{eval_name} on {model_name} ({error!r})"
+                for model_name, eval_name, error in failures
+            )
+        )
+
+
+def parse_generation_budgets(budgets) -> Optional[dict[str, int]]:
+    """
+    Parse `--generation-budget TYPE=TOKENS` arguments into a dict.
+    """
+    if not budgets:
+        return None
+    parsed = {}
+    for budget in budgets:
+        question_type, sep, tokens = budget.partition("=")
+        if not sep or not tokens.strip().isdigit():
+            raise ValueError(f"Invalid generation budget {budget!r}, expected TYPE=TOKENS")
+        parsed[question_type.strip().upper()] = int(tokens)
+    return parsed
+
+
+def sampler_config(sampler) -> dict:
+    """
+    Settings of a (possibly wrapped) sampler that change its responses.
+    """
+    while hasattr(sampler, "sampler"):
+        sampler = sampler.sampler
+    config = {"class": type(sampler).__name__}
+    for name in ("model", "temperature", "max_tokens", "system_message") + OPTIONAL_KEY_FIELDS:
+        if getattr(sampler, name, None) is not None:
+            config[name] = getattr(sampler, name)
+    return config
+
+
+def compare_models(model2scores):
+    """
+    Paired bootstrap of the score difference between every two models that ran
+    the same eval. Examples are in the same order for every model, so under
+    early stopping the models are compared on the examples they all reached.
+    """
+    import numpy as np
+
+    from ayamytk.test.bench.bootstrap import paired_bootstrap
+
+    comparisons = []
+    for model_a, model_b in itertools.combinations(model2scores, 2):
+        scores_a, scores_b = model2scores[model_a], model2scores[model_b]
+        length = min(len(scores_a), len(scores_b))
+        comparison = paired_bootstrap(
+            [np.nan if x is None else x for x in scores_a[:length]],
+            [np.nan if x is None else x for x in scores_b[:length]],
+        )
+        if comparison is not None:
+            comparisons.append({"model_a": model_a, "model_b": model_b, **comparison})
+    return comparisons
+
+
 def run(
     sampler=None,
     examples=None,
@@ -108,33 +283,131 @@ def run(
     samplers=MODELS,
     language=language_default,
     num_threads=50,
+    cache_path=None,
+    cache_read_only=False,
+    resume=True,
+    max_workers=200,
+    provider_concurrency=None,
+    scoring="reasoning",
+    stop_at_answer=True,
+    generation_budgets=None,
+    hedge_percentile=None,
+    request_timeout=None,
+    ci_width=None,
+    reference_score=None,
+    snapshot=None,
+    grader_concurrency=20,
+    grader_batch_size=1,
 ):
+    from ayamytk.test.bench import common
+    from ayamytk.test.bench.early_stopping import EarlyStopping
+
+    early_stopping = None
+    if ci_width is not None or reference_score is not None:
+        early_stopping = EarlyStopping(ci_width=ci_width, reference_score=reference_score)
+
+    @functools.cache
+    def get_grader():
+        return bench_sampler.OpenRouterSampler(model="google/gemini-2.0-flash-001")
+
     def get_evals(eval_name, debug_mode):
         num_examples = examples if examples is not None else (5 if debug_mode else None)
         # Set num_examples = None to reproduce full evals
         if eval_name == "mmlu_lite":
+            from ayamytk.test.bench.mmlu_eval import MMLUEval
+
             return MMLUEval(
                 num_examples=1 if debug_mode else num_examples, language=language, num_threads=num_threads,
+                scoring=scoring,
+                stop_at_answer=stop_at_answer,
+                # All MMLU questions are multiple choice
+                generation_budget=(generation_budgets or {}).get("MCQ"),
+                early_stopping=early_stopping,
+                snapshot=snapshot,
             )
         elif eval_name == "mg12l":
+            from ayamytk.test.bench.exam_eval import ExamEval
+
             return ExamEval(
-                grader_model=OpenRouterSampler(
-                    model="google/gemini-2.0-flash-001"
-                ),
+                grader_model=get_grader(),
                 num_examples=1 if debug_mode else num_examples,
                 language=language,
                 filter_types=["MCQ", "FIB", "TOF"],
                 num_threads=num_threads,
+                grader_concurrency=grader_concurrency,
+                grader_batch_size=grader_batch_size,
+                scoring=scoring,
+                stop_at_answer=stop_at_answer,
+                generation_budgets=generation_budgets,
+                early_stopping=early_stopping,
+                snapshot=snapshot,
             )
         else:
             raise Exception(f"Unrecognized eval type: {eval_name}")
 
+    def eval_config(eval_name):
+        # Eval settings that change the per-example results
+        config = dict(
+            eval=eval_name,
+            language=language,
+            examples=examples,
+            debug=debug,
+            scoring=scoring,
+            stop_at_answer=stop_at_answer,
+            generation_budgets=generation_budgets,
+        )
+        if eval_name == "mg12l":
+            config["grader"] = sampler_config(get_grader())
+            config["grader_batch_size"] = grader_batch_size
+        return config
+
     # Define available evaluations
     available_evals = evals_default.split(",")
 
+    # Keep alive as many connections per provider as requests can be in flight
+    from ayamytk.test.bench.sampler.clients import configure_pools
+
+    max_provider_concurrency = max(
+        [num_threads, grader_concurrency, *(provider_concurrency or {}).values()]
+    )
+    configure_pools(
+        max_connections=max(max_workers, max_provider_concurrency),
+        max_keepalive_connections=max_provider_concurrency,
+    )
+
     if sampler:
         samplers = {sampler.__name__: sampler}
 
+    # Fail before any pair starts rather than part way through the run
+    if scoring == "logprob":
+        for name, s in samplers.items():
+            try:
+                common.check_logprob_support(s)
+            except ValueError as e:
+                raise ValueError(f"Model {name!r}: {e}") from None
+
+    if request_timeout:
+        samplers = {
+            name: with_supported_options(s, timeout=request_timeout)
+            for name, s in samplers.items()
+        }
+
+    # The cache wraps the provider sampler directly, so its key is built from
+    # the model's own settings, then hedging, then the scheduler's limiter
+    if cache_path:
+        samplers = {
+            name: with_cache(
+                s, path=cache_path, read_only=cache_read_only, namespace=name
+            )
+            for name, s in samplers.items()
+        }
+
+    if hedge_percentile:
+        samplers = {
+            name: with_hedging(s, percentile=hedge_percentile)
+            for name, s in samplers.items()
+        }
+
     # Determine which evals to run
     if evals:
         requested_evals = evals.split(",")
@@ -151,56 +424,133 @@ def run(
         # Default to all available evals if none specified
         eval_names = available_evals
 
-    evals = {eval_name: get_evals(eval_name, debug) for eval_name in eval_names}
+    # Evals (and their datasets) are only loaded once their first job starts
+    eval_tasks = {}
+
+    async def get_eval(eval_name):
+        if eval_name not in eval_tasks:
+            eval_tasks[eval_name] = asyncio.ensure_future(
+                asyncio.to_thread(get_evals, eval_name, debug)
+            )
+        return await eval_tasks[eval_name]
 
     print(f"Running evaluations: {', '.join(eval_names)}")
-    print(evals)
     debug_suffix = "_DEBUG" if debug else ""
+    if scoring != "reasoning":
+        # Keep journals and reports of different scoring modes apart
+        debug_suffix = f"_{scoring.upper()}{debug_suffix}"
     print(debug_suffix)
-    mergekey2resultpath = {}
-    for model_name, sampler in samplers.items():
-        for eval_name, eval_obj in evals.items():
-            result = eval_obj(sampler)
+    scheduler = Scheduler(
+        max_workers=max_workers,
+        provider_concurrency=provider_concurrency,
+        default_provider_concurrency=num_threads,
+    )
+
+    async def run_pair(model_name, sampler, eval_name):
+        eval_obj = await get_eval(eval_name)
+        file_stem = f"./output/{eval_name}_{model_name}"
+        os.makedirs(os.path.dirname(file_stem), exist_ok=True)
+        # Completed examples are checkpointed here, and skipped if an interrupted
+        # run is restarted with the same settings
+        journal = EvalJournal(
+            f"{file_stem}{debug_suffix}.journal.jsonl",
+            resume=resume,
+            config={
+                "sampler": sampler_config(sampler),
+                "eval": eval_config(eval_name),
+            },
+        )
+        if journal.completed:
+            print(f"Resuming {file_stem} from {len(journal.completed)} journaled examples")
+        try:
+            result = await eval_obj.acall(scheduler.limit(sampler), journal=journal)
             # ^^^ how to use a sampler
-            file_stem = f"./output/{eval_name}_{model_name}"
-            os.makedirs(os.path.dirname(file_stem), exist_ok=True)
-            report_filename = f"{file_stem}{debug_suffix}.html"
-
-            print(f"Writing report to {report_filename}")
-            with open(report_filename, "w", encoding="utf-8") as fh:
-                fh.write(common.make_report(result))
-
-            # Handle the case where result.metrics might be None
-            if result.metrics is not None:
-                metrics = result.metrics | {"score": result.score}
-            else:
-                metrics = {"score": result.score}
-
-            print(metrics)
-            result_filename = f"{file_stem}{debug_suffix}.json"
-            with open(result_filename, "w", encoding="utf-8") as f:
-                f.write(json.dumps(metrics, indent=2))
-            print(f"Writing results to {result_filename}")
-            mergekey2resultpath[f"{file_stem}"] = result_filename
+        except BaseException:
+            journal.close()
+            raise
+        report_filename = f"{file_stem}{debug_suffix}.html"
+
+        print(f"Writing report to {report_filename}")
+        common.write_report(result, report_filename)
+
+        # Handle the case where result.metrics might be None
+        if result.metrics is not None:
+            metrics = result.metrics | {"score": result.score}
+        else:
+            metrics = {"score": result.score}
+
+        print(metrics)
+        result_filename = f"{file_stem}{debug_suffix}.json"
+        with open(result_filename, "w", encoding="utf-8") as f:
+            f.write(json.dumps(metrics, indent=2))
+        print(f"Writing results to {result_filename}")
+        # The run is complete, the next one samples every example again
+        journal.finish()
+        return file_stem, result_filename, result.scores
+
+    # Every (model, eval) pair runs at once, so the slowest provider rather than
+    # the sum of all of them sets the wall-clock time of the run
+    pairs = [
+        (model_name, sampler, eval_name)
+        for model_name, sampler in samplers.items()
+        for eval_name in eval_names
+    ]
+    try:
+        outcomes = scheduler.run(
+            [functools.partial(run_pair, *pair) for pair in pairs]
+        )
+    finally:
+        if hedge_percentile:
+            for s in samplers.values():
+                s.close()
+    mergekey2resultpath = {}
+    mergekey2scores = {}
+    failures = []
+    for (model_name, _, eval_name), outcome in zip(pairs, outcomes):
+        if isinstance(outcome, BaseException):
+            print(f"Error running {eval_name} on {model_name}: {outcome!r}")
+            failures.append((model_name, eval_name, outcome))
+            continue
+        _, result_filename, scores = outcome
+        mergekey2resultpath[(eval_name, model_name)] = result_filename
+        mergekey2scores[(eval_name, model_name)] = scores
+
+    for eval_name in eval_names:
+        comparisons = compare_models(
+            {
+                model_name: scores
+                for (name, model_name), scores in mergekey2scores.items()
+                if name == eval_name
+            }
+        )
+        if comparisons:
+            comparison_filename = f"./output/{eval_name}_paired{debug_suffix}.json"
+            with open(comparison_filename, "w", encoding="utf-8") as f:
+                f.write(json.dumps(comparisons, indent=2))
+            print(f"Writing paired comparisons to {comparison_filename}")
 
     merge_metrics = []
-    for eval_model_name, result_filename in mergekey2resultpath.items():
+    for (eval_name, model_name), result_filename in mergekey2resultpath.items():
         try:
             result = json.load(open(result_filename, "r+"))
         except Exception as e:
             print(e, result_filename)
             continue
         result = result.get("f1_score", result.get("score", None))
-        eval_name = eval_model_name[: eval_model_name.find("_")]
-        model_name = eval_model_name[eval_model_name.find("_") + 1 :]
         merge_metrics.append(
             {"eval_name": eval_name, "model_name": model_name, "metric": result}
         )
-    merge_metrics_df = pd.DataFrame(merge_metrics).pivot(
-        index=["model_name"], columns="eval_name"
-    )
-    print("\nAll results: ")
-    print(merge_metrics_df.to_markdown())
+    if merge_metrics:
+        import pandas as pd
+
+        merge_metrics_df = pd.DataFrame(merge_metrics).pivot(
+            index=["model_name"], columns="eval_name"
+        )
+        print("\nAll results: ")
+        print(merge_metrics_df.to_markdown())
+    if failures:
+        # Raised once every other pair has finished and written its results
+        raise EvalRunError(failures) from failures[0][2]
     return merge_metrics
 
 
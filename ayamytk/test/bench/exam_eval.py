@@ -1,23 +1,40 @@
+import asyncio
 import random
 import re
 import json
-from typing import Optional
+from typing import Optional, Union
 from datasets import load_dataset
 
 from ayamytk.test.bench.common import (
-    HTML_JINJA,
+    LOGPROB_ANSWER_PREFIX,
+    check_logprob_support,
+    logprob_options,
     normalize_extracted_answer,
     normalize_response,
-    map_with_progress,
+    map_pipeline,
+    amap_pipeline,
     aggregate_results,
-    jinja_env,
+    early_stopping_metrics,
+    map_until_stopped,
+    amap_until_stopped,
+    pick_choice,
+    text_choice,
+    sampler_metrics,
 )
+from ayamytk.test.bench.batching import AsyncMicroBatcher, MicroBatcher
+from ayamytk.test.bench.early_stopping import EarlyStopping
+from ayamytk.test.bench.examples import ArrowExamples
+from ayamytk.test.bench.journal import EvalJournal
+from ayamytk.test.bench.snapshot import load_snapshot
 from ayamytk.test.bench.models import (
+    AsyncSamplerBase,
     Eval,
     EvalResult,
     SamplerBase,
     SingleEvalResult,
     EvalResult,
+    as_async_sampler,
+    with_supported_options,
 )
 
 QUERY_TEMPLATE_MULTICHOICE_3 = """
@@ -57,9 +74,43 @@ SHORT_QNA_TEMPLATE = """
 
 FILL_IN_BLANK_ANSWER_PATTERN_TEMPLATE = "(?i){head}[ \t]*(?:\\()?(.*?)(?:\\))?$"
 
+# Used when scoring from logprobs: the model answers right after the answer prefix
+QUERY_TEMPLATE_MULTICHOICE_3_DIRECT = """
+အောက်ပါ မေးခွန်းအတွက် အဖြေမှန်ကို ရွေးပါ။ အဖြေသည် (က၊ ခ၊ ဂ) တစ်ခုတည်းသာ ဖြစ်ရမည်။
 
-def format_question(row):
-    if row["type"] == "MCQ":
+{question}
+
+(က) {option_a}
+(ခ) {option_b}
+(ဂ) {option_c}
+
+{answer_prefix}
+""".strip()
+
+TRUE_FALSE_DIRECT_TEMPLATE = """
+အောက်ပါကို မှားလျှင် (မှား)၊ မှန်လျှင် (မှန်) ဟု တစ်လုံးတည်းဖြင့်သာ ဖြေဆိုပါ။
+
+{question}
+
+{answer_prefix}
+""".strip()
+
+# Question types that can be scored from logprobs, and their possible answers
+LOGPROB_CHOICES = {
+    "MCQ": ["က", "ခ", "ဂ"],
+    "TOF": ["မှန်", "မှား"],
+}
+
+
+def format_question(row, scoring: str = "reasoning"):
+    if scoring == "logprob" and row["type"] in LOGPROB_CHOICES:
+        template = (
+            QUERY_TEMPLATE_MULTICHOICE_3_DIRECT
+            if row["type"] == "MCQ"
+            else TRUE_FALSE_DIRECT_TEMPLATE
+        )
+        return template.format(**row, answer_prefix=LOGPROB_ANSWER_PREFIX)
+    elif row["type"] == "MCQ":
         return QUERY_TEMPLATE_MULTICHOICE_3.format(**row)
     elif row["type"] == "TOF":
         return TRUE_FALSE_TEMPLATE.format(**row)
@@ -117,8 +168,79 @@ Grammatical and Syntactic Competence: <1-5>
 """
 
 
+# Grades several responses in one request, so the rubric is only sent once
+BATCH_GRADER_TEMPLATE = """
+You are an expert Burmese‐language examiner. Evaluate each of the {num_items} items below separately:
+
+{items}
+
+Using the scales below, assign each criterion of each item a score and give a one‐sentence justification. Then output just the scores of every item in a simple format.
+
+1. Content Relevancy (0-3)
+   0: Completely irrelevant
+   1: Tangentially relevant
+   2: Mostly relevant
+   3: Fully relevant
+
+2. Register Appropriateness (0-3)
+   0: Completely inappropriate register
+   1: Some register issues
+   2: Mostly appropriate
+   3: Fully appropriate (honorifics, particles, literary style)
+
+3. Grammatical and Syntactic Competence (1-5)
+   1: Very poor
+   2: Poor
+   3: Fair
+   4: Good
+   5: Excellent
+
+Output format, once for every item from 1 to {num_items}:
+
+Item <n>:
+Content Relevancy: <0-3>
+Register Appropriateness: <0-3>
+Grammatical and Syntactic Competence: <1-5>
+"""
+
+BATCH_GRADER_ITEM_TEMPLATE = """
+Item {n}:
+
+Question:
+{question}
+
+Expected Answer:
+{target}
+
+Model Response:
+{predicted_answer}
+""".strip()
+
+BATCH_GRADE_ITEM_REGEX = r"(?im)^[ \t*#]*Item\s*(\d+)\s*:?"
+
+# Seconds a grading call waits for its batch to fill before it is sent anyway
+GRADER_BATCH_WAIT = 0.1
+
+# Grader criteria and their valid ranges
+GRADE_SCHEMA = {
+    "Content Relevancy": (0, 3),
+    "Register Appropriateness": (0, 3),
+    "Grammatical and Syntactic Competence": (1, 5),
+}
+
+
 ANSWER_REGEX = "အဖြေ\\s*:(?:\\n{0,2})?"
 
+QUESTION_TYPES = ["MCQ", "TOF", "FIB", "SHORT_QNA", "LONG_QNA", "METAPHOR_QNA"]
+
+# Generation is stopped as soon as the response contains an answer line the
+# extraction regex would pick up. Not FIB: its regex only matches an answer on
+# the last line, so cutting the response short would change what is extracted
+STOP_PATTERNS = {
+    "MCQ": "(?i){}[ \t]*(?:\\()?[က-ဃ]".format(ANSWER_REGEX),
+    "TOF": TRUE_FALSE_ANSWER_PATTERN_TEMPLATE.format(ANSWER_REGEX),
+}
+
 
 class ExamEval(Eval):
     def __init__(
@@ -128,34 +250,89 @@ class ExamEval(Eval):
         language: str = "EN-US",
         filter_types: list[str] = None,
         num_threads: int = 50,
+        max_concurrency: int = 1000,
+        scoring: str = "reasoning",
+        stop_at_answer: bool = True,
+        generation_budgets: Optional[dict[str, int]] = None,
+        early_stopping: Optional[EarlyStopping] = None,
+        snapshot: Optional[str] = None,
+        grader_concurrency: int = 20,
+        grader_batch_size: int = 1,
     ):
         if language != "MYA":
             raise ValueError(f"Language {language} not supported")
-
-        # Load dataset and convert to list safely
-        dataset = load_dataset("Rickaym/Myanmar-G12L-Benchmark", split="test")
-        examples = list(dataset)
+        if scoring not in ("reasoning", "logprob"):
+            raise ValueError(f"Unknown scoring mode: {scoring}")
+
+        # Examples stay in the memory-mapped dataset, only row indices are kept
+        if snapshot:
+            dataset = load_snapshot(snapshot, "mg12l")
+        else:
+            dataset = load_dataset("Rickaym/Myanmar-G12L-Benchmark", split="test")
+        indices = range(len(dataset))
         if filter_types:
-            examples = [r for r in examples if r["type"] in filter_types]
+            indices = [
+                i for i, t in enumerate(dataset["type"]) if t in filter_types
+            ]
         # Sample if needed
-        if num_examples and len(examples) > num_examples:
-            examples = random.Random(0).sample(examples, num_examples)
+        if num_examples and len(indices) > num_examples:
+            indices = random.Random(0).sample(indices, num_examples)
+        elif early_stopping:
+            # Sequential evaluation needs the examples in a random order
+            indices = random.Random(0).sample(indices, len(indices))
 
-        self.examples = examples
+        self.examples = ArrowExamples(dataset, indices)
         self.grader_model = grader_model
+        # Grader calls in flight at once, separate from the sampling concurrency
+        self.grader_concurrency = grader_concurrency
+        # SHORT_QNA answers graded per grader request; batches only fill up to
+        # grader_concurrency, so keep that at least as large
+        self.grader_batch_size = grader_batch_size
         self.num_threads = num_threads
-
-    def grade_sample(self, question: str, target: str, predicted_answer: str) -> dict:
+        self.max_concurrency = max_concurrency
+        # "reasoning" extracts answers from chain-of-thought responses, "logprob"
+        # picks the most likely MCQ/TOF answer from a few next-token logprobs
+        self.scoring = scoring
+        # Stop generating right after the answer line, for samplers that support it
+        self.stop_at_answer = stop_at_answer
+        # max_tokens per question type, instead of the sampler's own
+        self.generation_budgets = generation_budgets or {}
+        # Stop once the score is known precisely enough, see EarlyStopping
+        self.early_stopping = early_stopping
+
+    def _uses_logprobs(self, row: dict) -> bool:
+        return self.scoring == "logprob" and row["type"] in LOGPROB_CHOICES
+
+    def _type_samplers(self, sampler) -> dict:
+        """
+        The sampler to use for each question type, with its generation settings.
+        """
+        if self.scoring == "logprob":
+            check_logprob_support(sampler)
+        samplers = {}
+        for question_type in QUESTION_TYPES:
+            if self.scoring == "logprob" and question_type in LOGPROB_CHOICES:
+                samplers[question_type] = sampler.with_options(
+                    **logprob_options(LOGPROB_CHOICES[question_type])
+                )
+                continue
+            options = {}
+            if self.stop_at_answer and question_type in STOP_PATTERNS:
+                options["stop_pattern"] = STOP_PATTERNS[question_type]
+            if question_type in self.generation_budgets:
+                options["max_tokens"] = self.generation_budgets[question_type]
+            samplers[question_type] = with_supported_options(sampler, **options)
+        return samplers
+
+    def _grader_messages(self, grader, question: str, target: str, predicted_answer: str):
         grader_prompt = GRADER_TEMPLATE.format(
             question=question,
             target=target,
             predicted_answer=predicted_answer,
         )
-        prompt_messages = [
-            self.grader_model._pack_message(content=grader_prompt, role="user")
-        ]
-        grade_output = self.grader_model(prompt_messages).response_text
+        return [grader._pack_message(content=grader_prompt, role="user")]
 
+    def _parse_grade(self, grade_output: str) -> dict:
         # Initialize empty dictionary for scores
         data = {}
         # Use regex to extract scores for each criterion
@@ -173,15 +350,8 @@ class ExamEval(Eval):
         if grammar_match:
             data["Grammatical and Syntactic Competence"] = int(grammar_match.group(1))
 
-        # Expected keys and their valid ranges
-        expected_schema = {
-            "Content Relevancy": (0, 3),
-            "Register Appropriateness": (0, 3),
-            "Grammatical and Syntactic Competence": (1, 5),
-        }
-
         # Validate presence and ranges
-        for key, (min_val, max_val) in expected_schema.items():
+        for key, (min_val, max_val) in GRADE_SCHEMA.items():
             if key not in data:
                 return {}
             value = data[key]
@@ -190,71 +360,266 @@ class ExamEval(Eval):
 
         return data
 
-    def __call__(self, sampler: SamplerBase) -> EvalResult:
-        def fn(row: dict):
-            prompt_messages = [
-                sampler._pack_message(content=format_question(row), role="user")
-            ]
-            response_text = normalize_response(sampler(prompt_messages).response_text)
-            extracted_answer = None
+    def _batch_grader_messages(self, grader, items: list[tuple[str, str, str]]):
+        grader_prompt = BATCH_GRADER_TEMPLATE.format(
+            num_items=len(items),
+            items="\n\n".join(
+                BATCH_GRADER_ITEM_TEMPLATE.format(
+                    n=n, question=question, target=target, predicted_answer=predicted
+                )
+                for n, (question, target, predicted) in enumerate(items, start=1)
+            ),
+        )
+        return [grader._pack_message(content=grader_prompt, role="user")]
+
+    def _parse_batch_grade(self, grade_output: str, num_items: int) -> list[dict]:
+        """
+        Per-item scores of a batched grade, {} for items that are missing or do
+        not match GRADE_SCHEMA.
+        """
+        grades = [{} for _ in range(num_items)]
+        headings = list(re.finditer(BATCH_GRADE_ITEM_REGEX, grade_output))
+        for heading, next_heading in zip(headings, headings[1:] + [None]):
+            n = int(heading.group(1))
+            end = next_heading.start() if next_heading else len(grade_output)
+            data = self._parse_grade(grade_output[heading.end() : end])
+            # Justifications may mention an item before its scores, so the
+            # last section with valid scores wins
+            if 1 <= n <= num_items and data:
+                grades[n - 1] = data
+        return grades
+
+    def grade_samples(self, items: list[tuple[str, str, str]]) -> list[dict]:
+        """
+        Grade (question, target, predicted_answer) items in one grader request,
+        grading any item whose scores cannot be parsed on its own.
+        """
+        if len(items) == 1:
+            return [self.grade_sample(*items[0])]
+        prompt_messages = self._batch_grader_messages(self.grader_model, items)
+        grade_output = self.grader_model(prompt_messages).response_text
+        grades = self._parse_batch_grade(grade_output, len(items))
+        return [grade or self.grade_sample(*item) for item, grade in zip(items, grades)]
+
+    async def agrade_samples(self, items: list[tuple[str, str, str]]) -> list[dict]:
+        if len(items) == 1:
+            return [await self.agrade_sample(*items[0])]
+        grader = as_async_sampler(self.grader_model)
+        prompt_messages = self._batch_grader_messages(grader, items)
+        grade_output = (await grader.acall(prompt_messages)).response_text
+        grades = self._parse_batch_grade(grade_output, len(items))
+        failed = [i for i, grade in enumerate(grades) if not grade]
+        regraded = await asyncio.gather(*(self.agrade_sample(*items[i]) for i in failed))
+        for i, grade in zip(failed, regraded):
+            grades[i] = grade
+        return grades
 
-            if row["type"] == "SHORT_QNA":
-                data = self.grade_sample(row["question"], row["answer"], response_text)
-
-                # Calculate total score as average of normalized scores
-                content_score = data["Content Relevancy"] / 3.0
-                register_score = data["Register Appropriateness"] / 3.0
-                grammar_score = data["Grammatical and Syntactic Competence"] / 5.0
-                score = (content_score + register_score + grammar_score) / 3.0
-
-                # Create metrics dictionary with individual scores
-                metrics = {
-                    "SHORT_QNA": score,
-                    "Content Relevancy": content_score,
-                    "Register Appropriateness": register_score,
-                    "Grammatical and Syntactic Competence": grammar_score,
-                }
-
-                # No extracted answer for SHORT_QNA
-                extracted_answer = json.dumps(metrics)
+    def grade_sample(self, question: str, target: str, predicted_answer: str) -> dict:
+        prompt_messages = self._grader_messages(
+            self.grader_model, question, target, predicted_answer
+        )
+        grade_output = self.grader_model(prompt_messages).response_text
+        return self._parse_grade(grade_output)
+
+    async def agrade_sample(
+        self, question: str, target: str, predicted_answer: str
+    ) -> dict:
+        grader = as_async_sampler(self.grader_model)
+        prompt_messages = self._grader_messages(
+            grader, question, target, predicted_answer
+        )
+        grade_output = (await grader.acall(prompt_messages)).response_text
+        return self._parse_grade(grade_output)
+
+    def _prompt_messages(self, sampler, row: dict):
+        return [
+            sampler._pack_message(
+                content=format_question(row, self.scoring), role="user"
+            )
+        ]
+
+    def _score(
+        self,
+        row: dict,
+        prompt_messages,
+        response_text: str,
+        data: Optional[dict] = None,
+        logprobs: Optional[list] = None,
+    ) -> SingleEvalResult:
+        extracted_answer = None
+
+        if self._uses_logprobs(row):
+            choices = LOGPROB_CHOICES[row["type"]]
+            extracted_answer = pick_choice(logprobs or [], choices)
+            if extracted_answer is None:
+                extracted_answer = text_choice(response_text, choices)
+            if row["type"] == "MCQ" and extracted_answer:
+                extracted_answer = normalize_extracted_answer(extracted_answer)
+
+            score = 1.0 if extracted_answer == row["answer"] else 0.0
+            metrics = {row["type"]: score}
+        elif row["type"] == "SHORT_QNA":
+            # Calculate total score as average of normalized scores
+            content_score = data["Content Relevancy"] / 3.0
+            register_score = data["Register Appropriateness"] / 3.0
+            grammar_score = data["Grammatical and Syntactic Competence"] / 5.0
+            score = (content_score + register_score + grammar_score) / 3.0
+
+            # Create metrics dictionary with individual scores
+            metrics = {
+                "SHORT_QNA": score,
+                "Content Relevancy": content_score,
+                "Register Appropriateness": register_score,
+                "Grammatical and Syntactic Competence": grammar_score,
+            }
+
+            # No extracted answer for SHORT_QNA
+            extracted_answer = json.dumps(metrics)
+        else:
+            if row["type"] == "MCQ":
+                regex = MULTILINGUAL_ANSWER_PATTERN_TEMPLATE.format(
+                    head=ANSWER_REGEX, answer=row["answer"]
+                )
+            elif row["type"] == "TOF":
+                regex = TRUE_FALSE_ANSWER_PATTERN_TEMPLATE.format(ANSWER_REGEX)
+            elif row["type"] == "FIB":
+                regex = FILL_IN_BLANK_ANSWER_PATTERN_TEMPLATE.format(
+                    head=ANSWER_REGEX
+                )
             else:
-                if row["type"] == "MCQ":
-                    regex = MULTILINGUAL_ANSWER_PATTERN_TEMPLATE.format(
-                        head=ANSWER_REGEX, answer=row["answer"]
-                    )
-                elif row["type"] == "TOF":
-                    regex = TRUE_FALSE_ANSWER_PATTERN_TEMPLATE.format(ANSWER_REGEX)
-                elif row["type"] == "FIB":
-                    regex = FILL_IN_BLANK_ANSWER_PATTERN_TEMPLATE.format(
-                        head=ANSWER_REGEX
-                    )
-                else:
-                    regex = ANSWER_REGEX
-
-                match = re.search(regex, response_text)
-                if match:
-                    try:
-                        extracted_answer = match.group(1)
-                    except IndexError:
-                        pass
-
-                if row["type"] == "MCQ" and extracted_answer:
-                    extracted_answer = normalize_extracted_answer(extracted_answer)
-
-                score = 1.0 if extracted_answer == row["answer"] else 0.0
-                metrics = {row["type"]: score}
-
-            html = jinja_env.from_string(HTML_JINJA).render(
-                prompt_messages=prompt_messages,
-                next_message=dict(content=response_text, role="assistant"),
-                score=score,
-                correct_answer=row["answer"],
-                extracted_answer=extracted_answer,
+                regex = ANSWER_REGEX
+
+            match = re.search(regex, response_text)
+            if match:
+                try:
+                    extracted_answer = match.group(1)
+                except IndexError:
+                    pass
+
+            if row["type"] == "MCQ" and extracted_answer:
+                extracted_answer = normalize_extracted_answer(extracted_answer)
+
+            score = 1.0 if extracted_answer == row["answer"] else 0.0
+            metrics = {row["type"]: score}
+
+        # Rendered into the example's HTML when the report is written
+        report_fields = dict(
+            correct_answer=row["answer"],
+            extracted_answer=extracted_answer,
+        )
+        convo = prompt_messages + [dict(content=response_text, role="assistant")]
+        return SingleEvalResult(
+            score=score, metrics=metrics, convo=convo, report_fields=report_fields
+        )
+
+    def _aggregate(self, results: list[SingleEvalResult]) -> EvalResult:
+        result = aggregate_results(results)
+        if self.early_stopping:
+            result.metrics.update(
+                early_stopping_metrics(results, self.early_stopping, len(self.examples))
+            )
+        return result
+
+    def _finish(self, row: dict, prompt_messages, response, data=None):
+        result = self._score(
+            row,
+            prompt_messages,
+            normalize_response(response.response_text),
+            data,
+            response.response_metadata.get("logprobs"),
+        )
+        result.metrics.update(sampler_metrics(response))
+        return result
+
+    def __call__(
+        self, sampler: SamplerBase, journal: Optional[EvalJournal] = None
+    ) -> EvalResult:
+        samplers = self._type_samplers(sampler)
+        if self.grader_batch_size > 1:
+            batcher = MicroBatcher(
+                self.grade_samples, self.grader_batch_size, GRADER_BATCH_WAIT
+            )
+            grade_short_answer = lambda *item: batcher(item)
+        else:
+            grade_short_answer = self.grade_sample
+
+        def sample(row: dict):
+            sampler = samplers[row["type"]]
+            prompt_messages = self._prompt_messages(sampler, row)
+            return prompt_messages, sampler(prompt_messages)
+
+        # Runs on the grader's own threads, so sampling carries on meanwhile
+        def grade(row: dict, sampled):
+            prompt_messages, response = sampled
+            data = None
+            if row["type"] == "SHORT_QNA":
+                data = grade_short_answer(
+                    row["question"],
+                    row["answer"],
+                    normalize_response(response.response_text),
+                )
+            return self._finish(row, prompt_messages, response, data)
+
+        def map_batch(rows):
+            return map_pipeline(
+                sample,
+                grade,
+                rows,
+                num_threads=self.num_threads,
+                g_threads=self.grader_concurrency,
+                journal=journal,
             )
-            convo = prompt_messages + [dict(content=response_text, role="assistant")]
-            return SingleEvalResult(
-                html=html, score=score, metrics=metrics, convo=convo
+
+        if self.early_stopping:
+            results = map_until_stopped(map_batch, self.examples, self.early_stopping)
+        else:
+            results = map_batch(self.examples)
+        return self._aggregate(results)
+
+    async def acall(
+        self,
+        sampler: Union[SamplerBase, AsyncSamplerBase],
+        journal: Optional[EvalJournal] = None,
+    ) -> EvalResult:
+        samplers = self._type_samplers(as_async_sampler(sampler))
+        if self.grader_batch_size > 1:
+            batcher = AsyncMicroBatcher(
+                self.agrade_samples, self.grader_batch_size, GRADER_BATCH_WAIT
+            )
+            agrade_short_answer = lambda *item: batcher(item)
+        else:
+            agrade_short_answer = self.agrade_sample
+
+        async def sample(row: dict):
+            sampler = samplers[row["type"]]
+            prompt_messages = self._prompt_messages(sampler, row)
+            return prompt_messages, await sampler.acall(prompt_messages)
+
+        async def grade(row: dict, sampled):
+            prompt_messages, response = sampled
+            data = None
+            if row["type"] == "SHORT_QNA":
+                data = await agrade_short_answer(
+                    row["question"],
+                    row["answer"],
+                    normalize_response(response.response_text),
+                )
+            return self._finish(row, prompt_messages, response, data)
+
+        def map_batch(rows):
+            return amap_pipeline(
+                sample,
+                grade,
+                rows,
+                max_concurrency=self.max_concurrency,
+                g_concurrency=self.grader_concurrency,
+                journal=journal,
             )
 
-        results = map_with_progress(fn, self.examples, num_threads=self.num_threads)
-        return aggregate_results(results)
+        if self.early_stopping:
+            results = await amap_until_stopped(
+                map_batch, self.examples, self.early_stopping
+            )
+        else:
+            results = await map_batch(self.examples)
+        return self._aggregate(results)
@@ -0,0 +1,25 @@
+from collections.abc import Sequence
+from typing import Any, Iterable, Optional
+
+
+class ArrowExamples(Sequence):
+    """
+    Benchmark examples left in their memory-mapped Arrow table.
+
+    Only the selected row indices are held in memory; an example is converted to
+    a dict when it is accessed, so evals can be constructed without reading the
+    whole dataset into Python objects.
+    """
+
+    def __init__(self, dataset: Any, indices: Optional[Iterable[int]] = None):
+        self.dataset = dataset
+        self.indices = list(range(len(dataset)) if indices is None else indices)
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ArrowExamples(self.dataset, self.indices[index])
+        return self.dataset[self.indices[index]]
+
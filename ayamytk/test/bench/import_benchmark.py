@@ -0,0 +1,85 @@
+"""
+Import-time regression check for the evals CLI.
+
+    python -m ayamytk.test.bench.import_benchmark
+
+Imports the module in a fresh interpreter with `-X importtime` and fails when it
+takes longer than the budget, or when it pulls in a module that should only be
+imported once a sampler or eval is created.
+"""
+
+import argparse
+import subprocess
+import sys
+
+DEFAULT_MODULE = "ayamytk.test.bench.evals"
+DEFAULT_BUDGET_MS = 250.0
+# Top-level packages that must not be imported at CLI startup
+HEAVY_MODULES = (
+    "cohere",
+    "datasets",
+    "httpx",
+    "jinja2",
+    "numpy",
+    "openai",
+    "pandas",
+    "pyarrow",
+    "requests",
+    "tqdm",
+)
+
+
+def import_times(module: str) -> dict[str, tuple[int, int]]:
+    """
+    Self and cumulative import time, in microseconds, of every module imported
+    along with `module`.
+    """
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--module", type=str, default=DEFAULT_MODULE)
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=DEFAULT_BUDGET_MS,
+        help="Maximum cumulative import time of the module",
+    )
+    parser.add_argument("--top", type=int, default=10, help="Slowest imports to show")
+    args = parser.parse_args()
+
+    times = import_times(args.module)
+    total_ms = times[args.module][1] / 1000
+    print(f"{args.module}: {total_ms:.1f} ms (budget {args.budget_ms:.0f} ms)")
+    for name, (self_us, _) in sorted(times.items(), key=lambda kv: -kv[1][0])[
+        : args.top
+    ]:
+        print(f"  {self_us / 1000:8.1f} ms  {name}")
+
+    failures = []
+    if total_ms > args.budget_ms:
+        failures.append(f"import took {total_ms:.1f} ms")
+    heavy = sorted({name.split(".")[0] for name in times} & set(HEAVY_MODULES))
+    if heavy:
+        failures.append(f"imported {', '.join(heavy)} at startup")
+    if failures:
+        print("FAILED: " + "; ".join(failures))
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import dataclasses
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Optional
+
+from ayamytk.test.bench.models import SingleEvalResult
+
+
+def example_key(example: Any) -> str:
+    """
+    Stable identifier for a benchmark example, derived from its contents.
+    """
+    encoded = json.dumps(example, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+
+class EvalJournal:
+    """
+    Append-only JSONL checkpoint of per-example results.
+
+    Every SingleEvalResult is written as soon as it completes, so that a run that
+    dies part way through can be restarted and only sample the missing examples.
+
+    The first line records `config`, the settings the results depend on (model,
+    prompts, scoring, ...). A journal written with a different config is
+    discarded instead of resumed. Call `finish` once the run completes, so the
+    next run samples everything again rather than replaying stored results.
+    """
+
+    def __init__(self, path: str, resume: bool = True, config: Optional[dict] = None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.completed: dict[str, SingleEvalResult] = {}
+        # Round-tripped through JSON so it compares equal to the stored header
+        self.config = json.loads(json.dumps(config or {}, sort_keys=True, default=str))
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        resume = resume and os.path.exists(path) and self._load()
+        self.fh = open(path, "a" if resume else "w", encoding="utf-8")
+        if not resume:
+            self.fh.write(json.dumps({"config": self.config}, ensure_ascii=False) + "\n")
+            self.fh.flush()
+
+    def _load(self) -> bool:
+        with open(self.path, "r", encoding="utf-8") as fh:
+            for i, line in enumerate(fh):
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A partially written line from a crashed run
+                    continue
+                if i == 0:
+                    if entry.get("config") != self.config:
+                        print(f"Settings changed since {self.path} was written, not resuming")
+                        return False
+                    continue
+                self.completed[entry["key"]] = SingleEvalResult(**entry["result"])
+        return True
+
+    def __contains__(self, example: Any) -> bool:
+        return example_key(example) in self.completed
+
+    def pending(self, examples: list[Any]) -> list[Any]:
+        return [x for x in examples if x not in self]
+
+    def record(self, example: Any, result: SingleEvalResult):
+        key = example_key(example)
+        line = json.dumps(
+            {"key": key, "result": dataclasses.asdict(result)},
+            ensure_ascii=False,
+            default=float,
+        )
+        with self.lock:
+            self.completed[key] = result
+            self.fh.write(line + "\n")
+            self.fh.flush()
+
+    def results(self, examples: list[Any]) -> list[SingleEvalResult]:
+        return [self.completed[example_key(x)] for x in examples]
+
+    def close(self):
+        self.fh.close()
+
+    def finish(self):
+        """
+        Close and delete the journal of a completed run.
+        """
+        self.close()
+        os.remove(self.path)
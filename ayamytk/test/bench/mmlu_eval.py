@@ -6,18 +6,37 @@ https://arxiv.org/abs/2009.03300
 
 import random
 import re
-from typing import Optional
+from typing import Optional, Union
 from datasets import load_dataset
 
 from ayamytk.test.bench.common import (
-    HTML_JINJA,
+    LOGPROB_ANSWER_PREFIX,
+    check_logprob_support,
+    logprob_options,
     normalize_extracted_answer,
     normalize_response,
     map_with_progress,
+    amap_with_progress,
     aggregate_results,
-    jinja_env,
+    early_stopping_metrics,
+    map_until_stopped,
+    amap_until_stopped,
+    pick_choice,
+    sampler_metrics,
+)
+from ayamytk.test.bench.early_stopping import EarlyStopping
+from ayamytk.test.bench.examples import ArrowExamples
+from ayamytk.test.bench.journal import EvalJournal
+from ayamytk.test.bench.snapshot import load_snapshot
+from ayamytk.test.bench.models import (
+    AsyncSamplerBase,
+    Eval,
+    EvalResult,
+    SamplerBase,
+    SingleEvalResult,
+    as_async_sampler,
+    with_supported_options,
 )
-from ayamytk.test.bench.models import Eval, EvalResult, SamplerBase, SingleEvalResult
 
 subject2category = {
     "abstract_algebra": "stem",
@@ -90,6 +109,23 @@ QUERY_TEMPLATE_MULTICHOICE = """
 (ဃ) {option_d}
 """.strip()
 
+# Used when scoring from logprobs: the model answers with the letter alone,
+# right after the answer prefix
+QUERY_TEMPLATE_MULTICHOICE_DIRECT = """
+အောက်ပါ မေးခွန်းအတွက် အဖြေမှန်ကို ရွေးပါ။ အဖြေသည် (က၊ ခ၊ ဂ၊ ဃ) တစ်ခုတည်းသာ ဖြစ်ရမည်။
+
+{question}
+
+(က) {option_a}
+(ခ) {option_b}
+(ဂ) {option_c}
+(ဃ) {option_d}
+
+{answer_prefix}
+""".strip()
+
+MULTICHOICE_LETTERS = ["က", "ခ", "ဂ", "ဃ"]
+
 ANSWER_PATTERN_MULTICHOICE = r"(?i)Answer[ \t]*:[ \t]*\$?([A-D])\$?"
 ANSWER_PATTERN = r"(?i)Answer\s*:\s*([^\n]+)"
 MULTILINGUAL_ANSWER_PATTERN_TEMPLATE = (
@@ -99,54 +135,186 @@ MULTILINGUAL_ANSWER_PATTERN_TEMPLATE = (
 MULTILINGUAL_ANSWER_REGEXES = [
     "အဖြေ\\s*:(?:\\n{0,2})?",
 ]
+# Generation is stopped as soon as the response contains an answer the
+# extraction regex would pick up
+ANSWER_STOP_PATTERN = (
+    "(?i)(?:" + "|".join(MULTILINGUAL_ANSWER_REGEXES) + ")[ \t]*(?:\\()?[က-ဃ]"
+)
 
 
-def format_multichoice_question(row):
+def format_multichoice_question(row, scoring: str = "reasoning"):
+    if scoring == "logprob":
+        return QUERY_TEMPLATE_MULTICHOICE_DIRECT.format(
+            **row, answer_prefix=LOGPROB_ANSWER_PREFIX
+        )
     return QUERY_TEMPLATE_MULTICHOICE.format(**row)
 
 
 class MMLUEval(Eval):
-    def __init__(self, num_examples: Optional[int] = None, language: str = "EN-US", num_threads: int = 50):
+    def __init__(
+        self,
+        num_examples: Optional[int] = None,
+        language: str = "EN-US",
+        num_threads: int = 50,
+        max_concurrency: int = 1000,
+        scoring: str = "reasoning",
+        stop_at_answer: bool = True,
+        generation_budget: Optional[int] = None,
+        early_stopping: Optional[EarlyStopping] = None,
+        snapshot: Optional[str] = None,
+    ):
         if language != "MYA":
             raise ValueError("Language must be MYA")
+        if scoring not in ("reasoning", "logprob"):
+            raise ValueError(f"Unknown scoring mode: {scoring}")
 
-        df = load_dataset("Rickaym/Burmese-MMLU-Lite", split="test")
-        examples = list(df)
+        if snapshot:
+            df = load_snapshot(snapshot, "mmlu_lite")
+        else:
+            df = load_dataset("Rickaym/Burmese-MMLU-Lite", split="test")
+        # Sampling row indices picks the same examples as sampling the rows
+        indices = range(len(df))
         if num_examples:
-            examples = random.Random(0).sample(examples, num_examples)
-        self.examples = examples
+            indices = random.Random(0).sample(indices, num_examples)
+        elif early_stopping:
+            # Sequential evaluation needs the examples in a random order
+            indices = random.Random(0).sample(indices, len(indices))
+        self.examples = ArrowExamples(df, indices)
         self.num_threads = num_threads
+        self.max_concurrency = max_concurrency
+        # "reasoning" extracts the answer from a chain-of-thought response,
+        # "logprob" picks the most likely letter from a few next-token logprobs
+        self.scoring = scoring
+        # Stop generating right after the answer line, for samplers that support it
+        self.stop_at_answer = stop_at_answer
+        # max_tokens for reasoning responses, instead of the sampler's own
+        self.generation_budget = generation_budget
+        # Stop once the score is known precisely enough, see EarlyStopping
+        self.early_stopping = early_stopping
+
+    def _scoring_sampler(self, sampler):
+        if self.scoring == "logprob":
+            check_logprob_support(sampler)
+            return sampler.with_options(**logprob_options(MULTICHOICE_LETTERS))
+        options = {}
+        if self.stop_at_answer:
+            options["stop_pattern"] = ANSWER_STOP_PATTERN
+        if self.generation_budget:
+            options["max_tokens"] = self.generation_budget
+        return with_supported_options(sampler, **options)
+
+    def _prompt_messages(self, sampler, row: dict):
+        return [
+            sampler._pack_message(
+                content=format_multichoice_question(row, self.scoring), role="user"
+            )
+        ]
+
+    def _extract_answer(self, response_text: str, logprobs: Optional[list] = None):
+        if self.scoring == "logprob":
+            choice = pick_choice(logprobs or [], MULTICHOICE_LETTERS)
+            if choice is None:
+                match = re.search("[က-ဃ]", response_text)
+                choice = match.group(0) if match else None
+            return normalize_extracted_answer(choice) if choice else None
+        for answer_regex in MULTILINGUAL_ANSWER_REGEXES:
+            regex = MULTILINGUAL_ANSWER_PATTERN_TEMPLATE.format(answer_regex)
+            match = re.search(regex, response_text)
+            if match:
+                return normalize_extracted_answer(match.group(1))
+        return None
+
+    def _score(
+        self,
+        row: dict,
+        prompt_messages,
+        response_text: str,
+        logprobs: Optional[list] = None,
+    ):
+        extracted_answer = self._extract_answer(response_text, logprobs)
+        score = 1.0 if extracted_answer == row["answer"] else 0.0
+        # Rendered into the example's HTML when the report is written
+        report_fields = dict(
+            correct_answer=row["answer"],
+            extracted_answer=extracted_answer,
+        )
+        convo = prompt_messages + [dict(content=response_text, role="assistant")]
+        category = subject2category.get(
+            row.get("sample_id", "").split("/")[0], "other"
+        )
+        return SingleEvalResult(
+            score=score,
+            metrics={category: score},
+            convo=convo,
+            report_fields=report_fields,
+        )
+
+    def _aggregate(self, results: list[SingleEvalResult]) -> EvalResult:
+        result = aggregate_results(results)
+        if self.early_stopping:
+            result.metrics.update(
+                early_stopping_metrics(results, self.early_stopping, len(self.examples))
+            )
+        return result
+
+    def __call__(
+        self, sampler: SamplerBase, journal: Optional[EvalJournal] = None
+    ) -> EvalResult:
+        sampler = self._scoring_sampler(sampler)
 
-    def __call__(self, sampler: SamplerBase) -> EvalResult:
         def fn(row: dict):
-            prompt_messages = [
-                sampler._pack_message(
-                    content=format_multichoice_question(row), role="user"
-                )
-            ]
-            response_text = normalize_response(sampler(prompt_messages).response_text)
-            extracted_answer = None
-            for answer_regex in MULTILINGUAL_ANSWER_REGEXES:
-                regex = MULTILINGUAL_ANSWER_PATTERN_TEMPLATE.format(answer_regex)
-                match = re.search(regex, response_text)
-                if match:
-                    extracted_answer = normalize_extracted_answer(match.group(1))
-                    break
-            score = 1.0 if extracted_answer == row["answer"] else 0.0
-            html = jinja_env.from_string(HTML_JINJA).render(
-                prompt_messages=prompt_messages,
-                next_message=dict(content=response_text, role="assistant"),
-                score=score,
-                correct_answer=row["answer"],
-                extracted_answer=extracted_answer,
+            prompt_messages = self._prompt_messages(sampler, row)
+            response = sampler(prompt_messages)
+            response_text = normalize_response(response.response_text)
+            result = self._score(
+                row,
+                prompt_messages,
+                response_text,
+                response.response_metadata.get("logprobs"),
             )
-            convo = prompt_messages + [dict(content=response_text, role="assistant")]
-            category = subject2category.get(
-                row.get("sample_id", "").split("/")[0], "other"
+            result.metrics.update(sampler_metrics(response))
+            return result
+
+        def map_batch(rows):
+            return map_with_progress(
+                fn, rows, num_threads=self.num_threads, journal=journal
             )
-            return SingleEvalResult(
-                html=html, score=score, metrics={category: score}, convo=convo
+
+        if self.early_stopping:
+            results = map_until_stopped(map_batch, self.examples, self.early_stopping)
+        else:
+            results = map_batch(self.examples)
+        return self._aggregate(results)
+
+    async def acall(
+        self,
+        sampler: Union[SamplerBase, AsyncSamplerBase],
+        journal: Optional[EvalJournal] = None,
+    ) -> EvalResult:
+        sampler = self._scoring_sampler(as_async_sampler(sampler))
+
+        async def fn(row: dict):
+            prompt_messages = self._prompt_messages(sampler, row)
+            response = await sampler.acall(prompt_messages)
+            response_text = normalize_response(response.response_text)
+            result = self._score(
+                row,
+                prompt_messages,
+                response_text,
+                response.response_metadata.get("logprobs"),
             )
+            result.metrics.update(sampler_metrics(response))
+            return result
 
-        results = map_with_progress(fn, self.examples, num_threads=self.num_threads)
-        return aggregate_results(results)
+        def map_batch(rows):
+            return amap_with_progress(
+                fn, rows, max_concurrency=self.max_concurrency, journal=journal
+            )
+
+        if self.early_stopping:
+            results = await amap_until_stopped(
+                map_batch, self.examples, self.early_stopping
+            )
+        else:
+            results = await map_batch(self.examples)
+        return self._aggregate(results)
@@ -1,5 +1,7 @@
+import asyncio
+import copy
 from dataclasses import dataclass, field
-from typing import Any, Optional
+from typing import Any, Optional, Union
 
 Message = dict[str, Any]  # keys role, content
 MessageList = list[Message]
@@ -16,6 +18,15 @@ class SamplerResponse:
     response_metadata: dict[str, Any]
 
 
+def _with_options(sampler, options: dict[str, Any]):
+    copied = copy.copy(sampler)
+    for name, value in options.items():
+        if not hasattr(sampler, name):
+            raise ValueError(f"{type(sampler).__name__} does not support {name!r}")
+        setattr(copied, name, value)
+    return copied
+
+
 class SamplerBase:
     """
     Base class for defining a sampling model, which can be evaluated,
@@ -28,6 +39,76 @@ class SamplerBase:
     def _pack_message(self, role, content):
         raise NotImplementedError
 
+    def with_options(self, **options: Any) -> "SamplerBase":
+        """
+        Return a copy of this sampler with some generation settings (such as
+        max_tokens) overridden. Raises ValueError for unsupported settings.
+        """
+        return _with_options(self, options)
+
+
+class AsyncSamplerBase:
+    """
+    Base class for samplers that are awaited from a single event loop instead
+    of occupying one thread per in-flight request.
+    """
+
+    async def acall(self, message_list: MessageList) -> SamplerResponse:
+        raise NotImplementedError
+
+    def _pack_message(self, role, content):
+        raise NotImplementedError
+
+    def with_options(self, **options: Any) -> "AsyncSamplerBase":
+        """
+        Return a copy of this sampler with some generation settings (such as
+        max_tokens) overridden. Raises ValueError for unsupported settings.
+        """
+        return _with_options(self, options)
+
+
+class SyncSamplerAdapter(AsyncSamplerBase):
+    """
+    Expose a synchronous sampler through the async protocol by running each
+    call in the event loop's default executor.
+    """
+
+    def __init__(self, sampler: SamplerBase):
+        self.sampler = sampler
+
+    def _pack_message(self, role, content):
+        return self.sampler._pack_message(role=role, content=content)
+
+    def with_options(self, **options: Any) -> "SyncSamplerAdapter":
+        return SyncSamplerAdapter(self.sampler.with_options(**options))
+
+    async def acall(self, message_list: MessageList) -> SamplerResponse:
+        return await asyncio.to_thread(self.sampler, message_list)
+
+
+def as_async_sampler(
+    sampler: Union[SamplerBase, AsyncSamplerBase],
+) -> AsyncSamplerBase:
+    """
+    Return the sampler itself if it is already async, otherwise wrap it.
+    """
+    if isinstance(sampler, AsyncSamplerBase):
+        return sampler
+    return SyncSamplerAdapter(sampler)
+
+
+def with_supported_options(sampler, **options: Any):
+    """
+    Apply each generation setting the sampler supports, and skip the rest.
+    """
+    for name, value in options.items():
+        try:
+            sampler = sampler.with_options(**{name: value})
+        except ValueError:
+            pass
+    return sampler
+
+
 @dataclass
 class EvalResult:
     """
@@ -38,6 +119,7 @@ class EvalResult:
     metrics: Optional[dict[str, float]] = None  # other metrics
     htmls: Optional[list[str]] = None  # strings of valid HTML
     convos: Optional[list[MessageList]] = None  # sampled conversations
+    scores: Optional[list[Optional[float]]] = None  # per-sample scores, in order
 
 
 @dataclass
@@ -50,6 +132,8 @@ class SingleEvalResult:
     metrics: dict[str, float] = field(default_factory=dict)
     html: Optional[str] = None
     convo: Optional[MessageList] = None  # sampled conversation
+    # Fields shown in the report, rendered into html only when a report is written
+    report_fields: Optional[dict[str, Any]] = None
 
 
 class Eval:
@@ -57,5 +141,10 @@ class Eval:
     Base class for defining an evaluation.
     """
 
-    def __call__(self, sampler: SamplerBase) -> EvalResult:
+    def __call__(self, sampler: SamplerBase, journal=None) -> EvalResult:
+        raise NotImplementedError
+
+    async def acall(
+        self, sampler: Union[SamplerBase, AsyncSamplerBase], journal=None
+    ) -> EvalResult:
         raise NotImplementedError
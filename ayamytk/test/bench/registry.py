@@ -0,0 +1,26 @@
+from collections.abc import Mapping
+from typing import Any, Callable
+
+
+class LazyRegistry(Mapping):
+    """
+    Mapping of names to objects that are only constructed when first looked up.
+
+    Listing the names (e.g. `--list-models`) constructs nothing, so provider SDKs
+    are not imported until a model is actually used.
+    """
+
+    def __init__(self, factories: dict[str, Callable[[], Any]]):
+        self.factories = factories
+        self.instances: dict[str, Any] = {}
+
+    def __getitem__(self, name: str) -> Any:
+        if name not in self.instances:
+            self.instances[name] = self.factories[name]()
+        return self.instances[name]
+
+    def __iter__(self):
+        return iter(self.factories)
+
+    def __len__(self) -> int:
+        return len(self.factories)
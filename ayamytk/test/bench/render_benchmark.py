@@ -0,0 +1,67 @@
+"""
+Per-example HTML rendering overhead, compiling templates on every call versus
+once through the template registry.
+
+    python -m ayamytk.test.bench.render_benchmark
+"""
+
+import argparse
+import timeit
+
+import jinja2
+
+from ayamytk.test.bench.common import HTML_JINJA, _message_template, get_template
+
+EXAMPLE = dict(
+    prompt_messages=[
+        {"role": "user", "content": "မေးခွန်း: အောက်ပါတို့မှ မှန်ကန်သော အဖြေကို ရွေးပါ။ " * 5}
+    ],
+    next_message={"role": "assistant", "content": "ရှင်းလင်းချက် ... အဖြေ: (က)"},
+    score=1.0,
+    correct_answer="A",
+    extracted_answer="A",
+)
+
+
+# How examples used to be rendered: parsed and compiled on every call
+uncached_env = jinja2.Environment(
+    loader=jinja2.BaseLoader(),
+    undefined=jinja2.StrictUndefined,
+    autoescape=jinja2.select_autoescape(["html", "xml"]),
+)
+uncached_env.globals["message_to_html"] = lambda message: uncached_env.from_string(
+    _message_template
+).render(
+    role=message["role"],
+    content=message["content"],
+    variant=message.get("variant", None),
+)
+
+
+def render_compiling_every_time() -> str:
+    return uncached_env.from_string(HTML_JINJA).render(**EXAMPLE)
+
+
+def render_from_registry() -> str:
+    return get_template("example.html").render(**EXAMPLE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--examples", type=int, default=2000)
+    args = parser.parse_args()
+
+    assert render_compiling_every_time() == render_from_registry()
+    for name, fn in [
+        ("from_string per example", render_compiling_every_time),
+        ("compiled once", render_from_registry),
+    ]:
+        seconds = min(timeit.repeat(fn, number=args.examples, repeat=3))
+        print(
+            f"{name:>24}: {seconds * 1e6 / args.examples:8.1f} us/example, "
+            f"{seconds:.2f} s for {args.examples} examples"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,42 @@
-from .chat_completion_sampler import ChatCompletionSampler
-from .open_router_sampler import OpenRouterSampler
-from .cohere_sampler import CohereSampler
-from .custom_sampler import CustomSampler
-
-__all__ = [
-    "ChatCompletionSampler",
-    "OpenRouterSampler",
-    "CohereSampler",
-    "CustomSampler",
-]
\ No newline at end of file
+import importlib
+from typing import TYPE_CHECKING
+
+# Samplers are imported on first access, so that importing the package does not
+# pull in every provider SDK
+_SAMPLER_MODULES = {
+    "ChatCompletionSampler": ".chat_completion_sampler",
+    "AsyncChatCompletionSampler": ".chat_completion_sampler",
+    "OpenRouterSampler": ".open_router_sampler",
+    "AsyncOpenRouterSampler": ".open_router_sampler",
+    "CohereSampler": ".cohere_sampler",
+    "AsyncCohereSampler": ".cohere_sampler",
+    "CustomSampler": ".custom_sampler",
+    "BatchedCustomSampler": ".custom_sampler",
+    "CachedSampler": ".cached_sampler",
+    "AsyncCachedSampler": ".cached_sampler",
+    "HedgedSampler": ".hedged_sampler",
+    "AsyncHedgedSampler": ".hedged_sampler",
+}
+
+if TYPE_CHECKING:
+    from .chat_completion_sampler import ChatCompletionSampler, AsyncChatCompletionSampler
+    from .open_router_sampler import OpenRouterSampler, AsyncOpenRouterSampler
+    from .cohere_sampler import CohereSampler, AsyncCohereSampler
+    from .custom_sampler import CustomSampler, BatchedCustomSampler
+    from .cached_sampler import CachedSampler, AsyncCachedSampler
+    from .hedged_sampler import HedgedSampler, AsyncHedgedSampler
+
+
+def __getattr__(name):
+    if name not in _SAMPLER_MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_SAMPLER_MODULES[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_SAMPLER_MODULES))
+
+
+__all__ = list(_SAMPLER_MODULES)
@@ -0,0 +1,235 @@
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+from ayamytk.test.bench.models import (
+    AsyncSamplerBase,
+    MessageList,
+    SamplerBase,
+    SamplerResponse,
+)
+
+DEFAULT_CACHE_PATH = "./output/cache/responses.sqlite"
+# Sampler settings that change the response when set
+OPTIONAL_KEY_FIELDS = ("logprobs", "stop", "stop_pattern")
+# JSON-serializable response metadata that is stored alongside the text
+CACHED_METADATA = ("logprobs",)
+
+
+class CachedSampler(SamplerBase):
+    """
+    Disk-backed response cache around another sampler.
+
+    Responses are stored in SQLite, keyed by a hash of the model name, temperature,
+    max_tokens, system message and the full message list. When the cache grows past
+    `max_size_bytes` the least recently used entries are evicted. In read-only mode
+    misses are still sampled, but nothing is written back.
+
+    `namespace` (e.g. the model's name in `evals.run`) is also part of the key,
+    and is required for samplers without a `model`, such as `CustomSampler`, so
+    that different checkpoints never share responses. Failed requests (responses
+    with an `error` in their metadata) are not cached.
+    """
+
+    def __init__(
+        self,
+        sampler: SamplerBase,
+        path: str = DEFAULT_CACHE_PATH,
+        max_size_bytes: Optional[int] = 1 << 30,
+        read_only: bool = False,
+        namespace: Optional[str] = None,
+    ):
+        if namespace is None and getattr(sampler, "model", None) is None:
+            raise ValueError(
+                f"{type(sampler).__name__} has no model name, "
+                "pass a namespace to identify its cached responses"
+            )
+        self.sampler = sampler
+        self.namespace = namespace
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.read_only = read_only
+        self.lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response_text TEXT NOT NULL, "
+            "message_list TEXT NOT NULL, size INTEGER NOT NULL, "
+            "last_access REAL NOT NULL)"
+        )
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(responses)")]
+        if "metadata" not in columns:
+            self.conn.execute("ALTER TABLE responses ADD COLUMN metadata TEXT")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_access "
+            "ON responses (last_access)"
+        )
+        # Total size of all entries, kept in the database so that every sampler
+        # (and process) sharing the file evicts against the same budget
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cache_size (total INTEGER NOT NULL)")
+        self.conn.execute(
+            "INSERT INTO cache_size SELECT COALESCE(SUM(size), 0) FROM responses "
+            "WHERE NOT EXISTS (SELECT 1 FROM cache_size)"
+        )
+        self.conn.commit()
+
+    @property
+    def provider(self):
+        return getattr(self.sampler, "provider", None)
+
+    def _pack_message(self, role, content):
+        return self.sampler._pack_message(role=role, content=content)
+
+    def with_options(self, **options: Any) -> "CachedSampler":
+        copied = copy.copy(self)
+        copied.sampler = self.sampler.with_options(**options)
+        return copied
+
+    def cache_key(self, message_list: MessageList) -> str:
+        payload = {
+            "model": getattr(self.sampler, "model", None),
+            "temperature": getattr(self.sampler, "temperature", None),
+            "max_tokens": getattr(self.sampler, "max_tokens", None),
+            "system_message": getattr(self.sampler, "system_message", None),
+            "message_list": message_list,
+        }
+        if self.namespace is not None:
+            payload["namespace"] = self.namespace
+        # Only part of the key when set, so existing entries stay valid
+        for name in OPTIONAL_KEY_FIELDS:
+            value = getattr(self.sampler, name, None)
+            if value is not None:
+                payload[name] = value
+        encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[SamplerResponse]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT response_text, message_list, metadata FROM responses "
+                "WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            if not self.read_only:
+                self.conn.execute(
+                    "UPDATE responses SET last_access = ? WHERE key = ?",
+                    (time.time(), key),
+                )
+                self.conn.commit()
+        return SamplerResponse(
+            response_text=row[0],
+            actual_queried_message_list=json.loads(row[1]),
+            response_metadata={**json.loads(row[2] or "{}"), "cache_hit": True},
+        )
+
+    def put(self, key: str, response: SamplerResponse):
+        if self.read_only or (response.response_metadata or {}).get("error"):
+            return
+        message_list = json.dumps(
+            response.actual_queried_message_list, ensure_ascii=False, default=str
+        )
+        metadata = json.dumps(
+            {
+                name: response.response_metadata[name]
+                for name in CACHED_METADATA
+                if (response.response_metadata or {}).get(name) is not None
+            },
+            ensure_ascii=False,
+        )
+        size = sum(
+            len(text.encode("utf-8"))
+            for text in (response.response_text, message_list, metadata)
+        )
+        with self.lock:
+            # Holds the write lock from the size lookup to the commit, so
+            # concurrent writers to the same file keep the total consistent
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                previous = self.conn.execute(
+                    "SELECT size FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO responses "
+                    "(key, response_text, message_list, size, last_access, metadata) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, response.response_text, message_list, size, time.time(), metadata),
+                )
+                self._add_size(size - (previous[0] if previous else 0))
+                self._evict()
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+
+    def _add_size(self, delta: int):
+        self.conn.execute("UPDATE cache_size SET total = total + ?", (delta,))
+
+    def _evict(self):
+        if self.max_size_bytes is None:
+            return
+        total = self.conn.execute("SELECT total FROM cache_size").fetchone()[0]
+        while total > self.max_size_bytes:
+            rows = self.conn.execute(
+                "SELECT key, size FROM responses ORDER BY last_access LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._add_size(-size)
+                total -= size
+                if total <= self.max_size_bytes:
+                    break
+
+    def _miss(self, response: SamplerResponse) -> SamplerResponse:
+        response.response_metadata = {
+            **(response.response_metadata or {}),
+            "cache_hit": False,
+        }
+        return response
+
+    def __call__(self, message_list: MessageList) -> SamplerResponse:
+        key = self.cache_key(message_list)
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        response = self.sampler(message_list)
+        self.put(key, response)
+        return self._miss(response)
+
+
+class AsyncCachedSampler(CachedSampler, AsyncSamplerBase):
+    """
+    Disk-backed response cache around an async sampler.
+    """
+
+    def __call__(self, message_list: MessageList) -> SamplerResponse:
+        raise TypeError(f"{type(self).__name__} is asynchronous, use acall instead")
+
+    async def acall(self, message_list: MessageList) -> SamplerResponse:
+        key = self.cache_key(message_list)
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        response = await self.sampler.acall(message_list)
+        self.put(key, response)
+        return self._miss(response)
+
+
+def with_cache(sampler: Any, **kwargs: Any) -> CachedSampler:
+    """
+    Wrap a sync or async sampler in the matching cache.
+    """
+    if isinstance(sampler, AsyncSamplerBase):
+        return AsyncCachedSampler(sampler, **kwargs)
+    return CachedSampler(sampler, **kwargs)
@@ -1,11 +1,26 @@
+import asyncio
+import re
 import time
 from typing import Any, Optional
 
 import openai
 import os
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 
-from ayamytk.test.bench.models import MessageList, SamplerBase, SamplerResponse
+from ayamytk.test.bench.models import (
+    AsyncSamplerBase,
+    MessageList,
+    SamplerBase,
+    SamplerResponse,
+)
+from ayamytk.test.bench.sampler.clients import get_client
+from ayamytk.test.bench.sampler.instrumentation import request_metrics
+from ayamytk.test.bench.sampler.rate_limiter import (
+    estimate_tokens,
+    estimate_usage,
+    get_rate_limiter,
+    usage_tokens,
+)
 
 
 class ChatCompletionSampler(SamplerBase):
@@ -13,6 +28,8 @@ class ChatCompletionSampler(SamplerBase):
     Sample from OpenAI's chat completion API
     """
 
+    client_class = OpenAI
+
     def __init__(
         self,
         model: str = "gpt-3.5-turbo",
@@ -21,14 +38,42 @@ class ChatCompletionSampler(SamplerBase):
         system_message: Optional[str] = None,
         temperature: float = 0.5,
         max_tokens: int = 1024,
+        rpm: Optional[float] = None,
+        tpm: Optional[float] = None,
+        logprobs: Optional[int] = None,
+        stop: Optional[list[str]] = None,
+        stop_pattern: Optional[str] = None,
+        timeout: Optional[float] = None,
     ):
-        self.client = OpenAI(base_url=base_url, api_key=os.environ.get(api_key_name))
+        # Samplers for the same endpoint and key share one connection pool
+        self.client_kwargs = dict(base_url=base_url, api_key=os.environ.get(api_key_name))
         # using api_key=os.environ.get("OPENAI_API_KEY")  # please set your API_KEY
         self.model = model
         self.system_message = system_message
         self.temperature = temperature
         self.max_tokens = max_tokens
+        # Number of top alternatives to return log probabilities for, per token
+        self.logprobs = logprobs
+        # Stop sequences handled by the API, excluded from the response
+        self.stop = stop
+        # Regex checked while streaming; generation is cut off as soon as the
+        # response matches it, and the match is kept in the response
+        self.stop_pattern = stop_pattern
+        # Seconds before a single request is abandoned and retried
+        self.timeout = timeout
         self.image_format = "url"
+        self.provider = base_url or "openai"
+        # Shared by every sampler hitting the same endpoint
+        self.rate_limiter = get_rate_limiter(self.provider, rpm=rpm, tpm=tpm)
+
+    @property
+    def client(self):
+        # Looked up per request, since async clients belong to the running loop
+        return get_client(
+            self.client_class,
+            asynchronous=isinstance(self, AsyncSamplerBase),
+            **self.client_kwargs,
+        )
 
     def _handle_image(
         self,
@@ -51,32 +96,91 @@ class ChatCompletionSampler(SamplerBase):
     def _pack_message(self, role: str, content: Any):
         return {"role": str(role), "content": content}
 
-    def __call__(self, message_list: MessageList) -> SamplerResponse:
+    def _prepare_messages(self, message_list: MessageList) -> MessageList:
         if self.system_message:
             message_list = [
                 self._pack_message("system", self.system_message)
             ] + message_list
+        return message_list
+
+    def _create_kwargs(self, message_list: MessageList) -> dict[str, Any]:
+        kwargs = dict(
+            model=self.model,
+            messages=message_list,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+        )
+        if self.logprobs:
+            kwargs.update(logprobs=True, top_logprobs=self.logprobs)
+        if self.stop:
+            kwargs["stop"] = self.stop
+        if self.stop_pattern:
+            kwargs.update(stream=True, stream_options={"include_usage": True})
+        if self.timeout:
+            kwargs["timeout"] = self.timeout
+        return kwargs
+
+    def _stream_delta(self, chunk) -> str:
+        if chunk.choices and chunk.choices[0].delta.content:
+            return chunk.choices[0].delta.content
+        return ""
+
+    def _read_stream(self, stream, sent: float) -> tuple[str, dict[str, Any]]:
+        content, usage, ttft = "", None, None
+        for chunk in stream:
+            usage = chunk.usage or usage
+            delta = self._stream_delta(chunk)
+            if delta and ttft is None:
+                ttft = time.monotonic() - sent
+            content += delta
+            if re.search(self.stop_pattern, content):
+                stream.close()
+                break
+        return content, {"usage": usage, "ttft": ttft}
+
+    def _response_metadata(self, response) -> dict[str, Any]:
+        metadata = {"usage": response.usage}
+        choice_logprobs = getattr(response.choices[0], "logprobs", None)
+        if self.logprobs and choice_logprobs and choice_logprobs.content:
+            metadata["logprobs"] = [t.model_dump() for t in choice_logprobs.content]
+        return metadata
+
+    def __call__(self, message_list: MessageList) -> SamplerResponse:
+        message_list = self._prepare_messages(message_list)
+        estimated_tokens = estimate_tokens(message_list, self.max_tokens)
+        start = time.monotonic()
         trial = 0
         while True:
             try:
+                self.rate_limiter.acquire(estimated_tokens)
+                sent = time.monotonic()
                 response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=message_list,
-                    temperature=self.temperature,
-                    max_tokens=self.max_tokens,
+                    **self._create_kwargs(message_list)
                 )
-                # Try again if choices is None
-                if not hasattr(response, "choices") or response.choices is None:
-                    print("API returned no choices; retrying")
-                    trial += 1
-                    time.sleep(2**trial)
-                    continue
-                content = response.choices[0].message.content
+                if self.stop_pattern:
+                    content, metadata = self._read_stream(response, sent)
+                    if metadata["usage"] is None:
+                        # Usage comes with the last chunk, which a stream
+                        # stopped at the answer never reads
+                        metadata["usage"] = estimate_usage(message_list, content)
+                else:
+                    # Try again if choices is None
+                    if not hasattr(response, "choices") or response.choices is None:
+                        print("API returned no choices; retrying")
+                        trial += 1
+                        time.sleep(2**trial)
+                        continue
+                    content = response.choices[0].message.content
+                    metadata = self._response_metadata(response)
                 if content is None:
                     raise ValueError("OpenAI API returned empty response; retrying")
+                self.rate_limiter.settle(estimated_tokens, usage_tokens(metadata["usage"]))
+                metadata.update(
+                    request_metrics(start, trial, metadata["usage"], metadata.get("ttft"))
+                )
                 return SamplerResponse(
                     response_text=content,
-                    response_metadata={"usage": response.usage},
+                    response_metadata=metadata,
                     actual_queried_message_list=message_list,
                 )
             # NOTE: BadRequestError is triggered once for MMMU, please uncomment if you are reruning MMMU
@@ -84,9 +188,21 @@ class ChatCompletionSampler(SamplerBase):
                 print("Bad Request Error", e)
                 return SamplerResponse(
                     response_text="No response (bad request).",
-                    response_metadata={"usage": None},
+                    response_metadata={
+                        "usage": None,
+                        "error": "bad_request",
+                        **request_metrics(start, trial),
+                    },
                     actual_queried_message_list=message_list,
                 )
+            except openai.APITimeoutError as e:
+                exception_backoff = 2**trial  # expontial back off
+                print(
+                    f"Request timed out so retry {trial} after {exception_backoff} sec",
+                    e,
+                )
+                time.sleep(exception_backoff)
+                trial += 1
             except Exception as e:
                 if "limit" not in str(e).lower():
                     raise e
@@ -96,6 +212,100 @@ class ChatCompletionSampler(SamplerBase):
                     f"Rate limit exception so wait and retry {trial} after {exception_backoff} sec",
                     e,
                 )
-                time.sleep(exception_backoff)
+                self.rate_limiter.backoff(exception_backoff)
+                trial += 1
+            # unknown error shall throw exception
+
+
+class AsyncChatCompletionSampler(ChatCompletionSampler, AsyncSamplerBase):
+    """
+    Sample from OpenAI's chat completion API using AsyncOpenAI, so that many
+    requests can be in flight from a single event loop.
+    """
+
+    client_class = AsyncOpenAI
+
+    def __call__(self, message_list: MessageList) -> SamplerResponse:
+        raise TypeError(f"{type(self).__name__} is asynchronous, use acall instead")
+
+    async def _aread_stream(self, stream, sent: float) -> tuple[str, dict[str, Any]]:
+        content, usage, ttft = "", None, None
+        async for chunk in stream:
+            usage = chunk.usage or usage
+            delta = self._stream_delta(chunk)
+            if delta and ttft is None:
+                ttft = time.monotonic() - sent
+            content += delta
+            if re.search(self.stop_pattern, content):
+                await stream.close()
+                break
+        return content, {"usage": usage, "ttft": ttft}
+
+    async def acall(self, message_list: MessageList) -> SamplerResponse:
+        message_list = self._prepare_messages(message_list)
+        estimated_tokens = estimate_tokens(message_list, self.max_tokens)
+        start = time.monotonic()
+        trial = 0
+        while True:
+            try:
+                await self.rate_limiter.aacquire(estimated_tokens)
+                sent = time.monotonic()
+                response = await self.client.chat.completions.create(
+                    **self._create_kwargs(message_list)
+                )
+                if self.stop_pattern:
+                    content, metadata = await self._aread_stream(response, sent)
+                    if metadata["usage"] is None:
+                        # Usage comes with the last chunk, which a stream
+                        # stopped at the answer never reads
+                        metadata["usage"] = estimate_usage(message_list, content)
+                else:
+                    # Try again if choices is None
+                    if not hasattr(response, "choices") or response.choices is None:
+                        print("API returned no choices; retrying")
+                        trial += 1
+                        await asyncio.sleep(2**trial)
+                        continue
+                    content = response.choices[0].message.content
+                    metadata = self._response_metadata(response)
+                if content is None:
+                    raise ValueError("OpenAI API returned empty response; retrying")
+                self.rate_limiter.settle(estimated_tokens, usage_tokens(metadata["usage"]))
+                metadata.update(
+                    request_metrics(start, trial, metadata["usage"], metadata.get("ttft"))
+                )
+                return SamplerResponse(
+                    response_text=content,
+                    response_metadata=metadata,
+                    actual_queried_message_list=message_list,
+                )
+            except openai.BadRequestError as e:
+                print("Bad Request Error", e)
+                return SamplerResponse(
+                    response_text="No response (bad request).",
+                    response_metadata={
+                        "usage": None,
+                        "error": "bad_request",
+                        **request_metrics(start, trial),
+                    },
+                    actual_queried_message_list=message_list,
+                )
+            except openai.APITimeoutError as e:
+                exception_backoff = 2**trial  # expontial back off
+                print(
+                    f"Request timed out so retry {trial} after {exception_backoff} sec",
+                    e,
+                )
+                await asyncio.sleep(exception_backoff)
+                trial += 1
+            except Exception as e:
+                if "limit" not in str(e).lower():
+                    raise e
+
+                exception_backoff = 2**trial  # expontial back off
+                print(
+                    f"Rate limit exception so wait and retry {trial} after {exception_backoff} sec",
+                    e,
+                )
+                self.rate_limiter.backoff(exception_backoff)
                 trial += 1
-            # unknown error shall throw exception
\ No newline at end of file
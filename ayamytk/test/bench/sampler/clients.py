@@ -0,0 +1,106 @@
+import asyncio
+import threading
+from typing import Any
+
+import httpx
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2 = True
+except ImportError:
+    # HTTP/2 needs `pip install httpx[http2]`, fall back to HTTP/1.1 keep-alive
+    HTTP2 = False
+
+# Defaults sized for the default scheduler budget: up to 200 requests in flight
+# in total, 50 of them to any one provider. See configure_pools
+MAX_CONNECTIONS = 200
+MAX_KEEPALIVE_CONNECTIONS = 50
+KEEPALIVE_EXPIRY = 60.0
+# Generations can take minutes; samplers may still pass a shorter per-request
+# timeout
+REQUEST_TIMEOUT = 600.0
+CONNECT_TIMEOUT = 10.0
+
+_clients: dict[tuple, Any] = {}
+# The httpx clients of async API clients, which need closing with their loop
+_async_http_clients: dict[tuple, httpx.AsyncClient] = {}
+_lock = threading.Lock()
+
+
+def configure_pools(max_connections: int, max_keepalive_connections: int):
+    """
+    Size the connection pools of clients created from now on, e.g. to the
+    scheduler's thread budget and per-provider concurrency. Each pool serves
+    a single endpoint, so keeping alive as many connections as requests can be
+    in flight to one provider avoids reconnecting after every request.
+    """
+    global MAX_CONNECTIONS, MAX_KEEPALIVE_CONNECTIONS
+    MAX_CONNECTIONS = max_connections
+    MAX_KEEPALIVE_CONNECTIONS = min(max_keepalive_connections, max_connections)
+
+
+def http_client(asynchronous: bool = False) -> httpx.Client:
+    """
+    An HTTP client with a keep-alive connection pool sized for eval concurrency.
+    """
+    client_class = httpx.AsyncClient if asynchronous else httpx.Client
+    return client_class(
+        http2=HTTP2,
+        limits=httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT),
+        follow_redirects=True,
+    )
+
+
+def get_client(
+    client_class: type,
+    http_client_arg: str = "http_client",
+    asynchronous: bool = False,
+    **kwargs: Any,
+) -> Any:
+    """
+    Shared API client for the given class and constructor arguments (base URL,
+    API key, ...), so every sampler talking to the same endpoint with the same key
+    reuses one connection pool.
+
+    `http_client_arg` is the name under which the client class takes its httpx
+    client (`http_client` for OpenAI, `httpx_client` for Cohere).
+
+    Async clients are bound to the event loop they are used from, so they are
+    shared per running loop and must be requested from within it. Close them
+    with aclose_clients before the loop is closed.
+    """
+    loop = asyncio.get_running_loop() if asynchronous else None
+    key = (
+        client_class,
+        tuple(sorted(kwargs.items())),
+        MAX_CONNECTIONS,
+        MAX_KEEPALIVE_CONNECTIONS,
+        loop,
+    )
+    with _lock:
+        if key not in _clients:
+            http = http_client(asynchronous)
+            _clients[key] = client_class(**kwargs, **{http_client_arg: http})
+            if asynchronous:
+                _async_http_clients[key] = http
+        return _clients[key]
+
+
+async def aclose_clients():
+    """
+    Close the async clients of the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    with _lock:
+        keys = [key for key in _async_http_clients if key[-1] is loop]
+        http_clients = [_async_http_clients.pop(key) for key in keys]
+        for key in keys:
+            del _clients[key]
+    for http in http_clients:
+        await http.aclose()
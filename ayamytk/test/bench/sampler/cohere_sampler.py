@@ -1,7 +1,23 @@
+import asyncio
+import re
 import time
 import cohere.client_v2 as cohere
-from typing import Optional
-from ayamytk.test.bench.models import MessageList, SamplerBase, SamplerResponse
+from typing import Any, Optional
+from ayamytk.test.bench.models import (
+    AsyncSamplerBase,
+    MessageList,
+    SamplerBase,
+    SamplerResponse,
+)
+from ayamytk.test.bench.sampler.clients import REQUEST_TIMEOUT, get_client
+from ayamytk.test.bench.sampler.instrumentation import request_metrics
+from ayamytk.test.bench.sampler.rate_limiter import (
+    estimate_tokens,
+    estimate_usage,
+    get_rate_limiter,
+    is_rate_limit_error,
+    usage_tokens,
+)
 
 
 class CohereSampler(SamplerBase):
@@ -9,44 +25,169 @@ class CohereSampler(SamplerBase):
     Sample from Cohere API using cohere library
     """
 
+    client_class = cohere.ClientV2
+
     def __init__(
         self,
         model: str,
         system_message: Optional[str] = None,
         temperature: float = 0.0,
         max_tokens: int = 1024,
+        rpm: Optional[float] = None,
+        tpm: Optional[float] = None,
+        stop: Optional[list[str]] = None,
+        stop_pattern: Optional[str] = None,
+        timeout: Optional[float] = None,
     ):
         self.model = model
         self.system_message = system_message
         self.temperature = temperature
         self.max_tokens = max_tokens
-        self.client = cohere.ClientV2()
+        # Stop sequences handled by the API, excluded from the response
+        self.stop = stop
+        # Regex checked while streaming; generation is cut off as soon as the
+        # response matches it, and the match is kept in the response
+        self.stop_pattern = stop_pattern
+        # ClientV2 does not default its timeout when given an httpx client
+        self.timeout = timeout or REQUEST_TIMEOUT
+        self.provider = "cohere"
+        # Shared by every Cohere sampler in the process
+        self.rate_limiter = get_rate_limiter(self.provider, rpm=rpm, tpm=tpm)
+
+    @property
+    def client(self):
+        # Shared by every Cohere sampler, so they reuse one connection pool.
+        # Looked up per request, since async clients belong to the running loop
+        return get_client(
+            self.client_class,
+            http_client_arg="httpx_client",
+            asynchronous=isinstance(self, AsyncSamplerBase),
+            timeout=self.timeout,
+        )
 
     def _pack_message(self, role, content):
         return {"role": str(role), "content": content}
 
+    def _chat_kwargs(self, message_list: MessageList) -> dict[str, Any]:
+        messages = message_list.copy()
+        if self.system_message:
+            # Add system message if provided
+            messages = [{"role": "system", "content": self.system_message}] + messages
+        kwargs = dict(
+            model=self.model,
+            messages=messages,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+        )
+        if self.stop:
+            kwargs["stop_sequences"] = self.stop
+        return kwargs
+
+    def _stream_event(self, event, content: str, usage: Any) -> tuple[str, Any]:
+        if event.type == "content-delta":
+            content += event.delta.message.content.text or ""
+        elif event.type == "message-end":
+            usage = event.delta.usage
+        return content, usage
+
+    def _chat(self, message_list: MessageList) -> tuple[str, Any, Optional[float]]:
+        kwargs = self._chat_kwargs(message_list)
+        if not self.stop_pattern:
+            response = self.client.chat(**kwargs)
+            return response.message.content[0].text, response.usage, None
+        sent = time.monotonic()
+        content, usage, ttft = "", None, None
+        stream = self.client.chat_stream(**kwargs)
+        for event in stream:
+            content, usage = self._stream_event(event, content, usage)
+            if content and ttft is None:
+                ttft = time.monotonic() - sent
+            if re.search(self.stop_pattern, content):
+                stream.close()
+                break
+        # Usage comes with the message-end event, which a stream stopped at the
+        # answer never reads
+        return content, usage or estimate_usage(message_list, content), ttft
+
     def __call__(self, message_list: MessageList) -> SamplerResponse:
+        estimated_tokens = estimate_tokens(message_list, self.max_tokens)
+        start = time.monotonic()
         trial = 0
         while True:
             try:
-                messages = message_list.copy()
-                if self.system_message:
-                    # Add system message if provided
-                    messages = [
-                        {"role": "system", "content": self.system_message}
-                    ] + messages
-
-                response = self.client.chat(
-                    model=self.model,
-                    messages=messages,
-                    max_tokens=self.max_tokens,
-                    temperature=self.temperature,
+                self.rate_limiter.acquire(estimated_tokens)
+                content, usage, ttft = self._chat(message_list)
+
+                self.rate_limiter.settle(estimated_tokens, usage_tokens(usage))
+                return SamplerResponse(
+                    response_text=content,
+                    actual_queried_message_list=message_list,
+                    response_metadata={
+                        "usage": usage,
+                        **request_metrics(start, trial, usage, ttft),
+                    },
+                )
+            except Exception as e:
+                exception_backoff = 2**trial  # exponential back off
+                print(
+                    f"Exception so wait and retry {trial} after {exception_backoff} sec",
+                    e,
                 )
+                if is_rate_limit_error(e):
+                    self.rate_limiter.backoff(exception_backoff)
+                else:
+                    time.sleep(exception_backoff)
+                trial += 1
+
+
+class AsyncCohereSampler(CohereSampler, AsyncSamplerBase):
+    """
+    Sample from Cohere API using the async cohere client
+    """
+
+    client_class = cohere.AsyncClientV2
+
+    def __call__(self, message_list: MessageList) -> SamplerResponse:
+        raise TypeError(f"{type(self).__name__} is asynchronous, use acall instead")
+
+    async def _achat(
+        self, message_list: MessageList
+    ) -> tuple[str, Any, Optional[float]]:
+        kwargs = self._chat_kwargs(message_list)
+        if not self.stop_pattern:
+            response = await self.client.chat(**kwargs)
+            return response.message.content[0].text, response.usage, None
+        sent = time.monotonic()
+        content, usage, ttft = "", None, None
+        stream = self.client.chat_stream(**kwargs)
+        async for event in stream:
+            content, usage = self._stream_event(event, content, usage)
+            if content and ttft is None:
+                ttft = time.monotonic() - sent
+            if re.search(self.stop_pattern, content):
+                await stream.aclose()
+                break
+        # Usage comes with the message-end event, which a stream stopped at the
+        # answer never reads
+        return content, usage or estimate_usage(message_list, content), ttft
+
+    async def acall(self, message_list: MessageList) -> SamplerResponse:
+        estimated_tokens = estimate_tokens(message_list, self.max_tokens)
+        start = time.monotonic()
+        trial = 0
+        while True:
+            try:
+                await self.rate_limiter.aacquire(estimated_tokens)
+                content, usage, ttft = await self._achat(message_list)
 
+                self.rate_limiter.settle(estimated_tokens, usage_tokens(usage))
                 return SamplerResponse(
-                    response_text=response.message.content[0].text,
+                    response_text=content,
                     actual_queried_message_list=message_list,
-                    response_metadata={},
+                    response_metadata={
+                        "usage": usage,
+                        **request_metrics(start, trial, usage, ttft),
+                    },
                 )
             except Exception as e:
                 exception_backoff = 2**trial  # exponential back off
@@ -54,5 +195,8 @@ class CohereSampler(SamplerBase):
                     f"Exception so wait and retry {trial} after {exception_backoff} sec",
                     e,
                 )
-                time.sleep(exception_backoff)
+                if is_rate_limit_error(e):
+                    self.rate_limiter.backoff(exception_backoff)
+                else:
+                    await asyncio.sleep(exception_backoff)
                 trial += 1
@@ -1,7 +1,13 @@
 import time
-from typing import Callable
+from typing import Callable, Optional
 from traceback import print_exc
+from ayamytk.test.bench.batching import MicroBatcher
 from ayamytk.test.bench.models import MessageList, SamplerBase, SamplerResponse
+from ayamytk.test.bench.sampler.instrumentation import request_metrics
+from ayamytk.test.bench.sampler.rate_limiter import (
+    get_rate_limiter,
+    is_rate_limit_error,
+)
 
 
 class CustomSampler(SamplerBase):
@@ -9,21 +15,30 @@ class CustomSampler(SamplerBase):
     Custom call sample.
     """
 
-    def __init__(self, chat: Callable[[MessageList], str]):
+    def __init__(
+        self,
+        chat: Callable[[MessageList], str],
+        provider: str = "custom",
+        rpm: Optional[float] = None,
+    ):
         self.chat = chat
+        self.provider = provider
+        self.rate_limiter = get_rate_limiter(provider, rpm=rpm)
 
     def _pack_message(self, role, content):
         return {"role": str(role), "content": content}
 
     def __call__(self, message_list: MessageList) -> SamplerResponse:
+        start = time.monotonic()
         trial = 0
         while True:
             try:
+                self.rate_limiter.acquire()
                 response = self.chat(message_list)
                 return SamplerResponse(
                     response_text=response,
                     actual_queried_message_list=message_list,
-                    response_metadata={},
+                    response_metadata=request_metrics(start, trial),
                 )
             except Exception as e:
                 exception_backoff = 2**trial  # exponential back off
@@ -31,6 +46,74 @@ class CustomSampler(SamplerBase):
                     f"Exception so wait and retry {trial} after {exception_backoff} sec",
                 )
                 print_exc()
-                time.sleep(exception_backoff)
+                if is_rate_limit_error(e):
+                    self.rate_limiter.backoff(exception_backoff)
+                else:
+                    time.sleep(exception_backoff)
                 trial += 1
                 # unknown error shall throw exception
+
+
+class BatchedCustomSampler(SamplerBase):
+    """
+    Custom call sample for engines that generate a whole batch at once.
+
+    Concurrent calls are gathered into micro-batches of up to `max_batch_size`
+    message lists, waiting at most `max_wait` seconds for a batch to fill, and
+    sent to `chat_batch` in a single call. Batches can only be as large as the
+    number of concurrent callers, so keep the provider concurrency of `evals.run`
+    at or above `max_batch_size`.
+    """
+
+    def __init__(
+        self,
+        chat_batch: Callable[[list[MessageList]], list[str]],
+        max_batch_size: int = 32,
+        max_wait: float = 0.05,
+        provider: str = "custom",
+        rpm: Optional[float] = None,
+    ):
+        self.chat_batch = chat_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.provider = provider
+        self.rate_limiter = get_rate_limiter(provider, rpm=rpm)
+        self.batcher = MicroBatcher(
+            self._run_batch, max_batch_size=max_batch_size, max_wait=max_wait
+        )
+
+    def _pack_message(self, role, content):
+        return {"role": str(role), "content": content}
+
+    def _run_batch(self, message_lists: list[MessageList]) -> list[tuple[str, int, int]]:
+        trial = 0
+        while True:
+            try:
+                self.rate_limiter.acquire()
+                responses = self.chat_batch(message_lists)
+                break
+            except Exception as e:
+                exception_backoff = 2**trial  # exponential back off
+                print(
+                    f"Exception so wait and retry {trial} after {exception_backoff} sec",
+                )
+                print_exc()
+                if is_rate_limit_error(e):
+                    self.rate_limiter.backoff(exception_backoff)
+                else:
+                    time.sleep(exception_backoff)
+                trial += 1
+        # A length mismatch is reported to every caller by the batcher
+        return [(response, trial, len(message_lists)) for response in responses]
+
+    def __call__(self, message_list: MessageList) -> SamplerResponse:
+        start = time.monotonic()
+        response, trial, batch_size = self.batcher(message_list)
+        return SamplerResponse(
+            response_text=response,
+            actual_queried_message_list=message_list,
+            response_metadata={
+                **request_metrics(start, trial),
+                "batch_size": batch_size,
+            },
+        )
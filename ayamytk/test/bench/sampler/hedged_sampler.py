@@ -0,0 +1,204 @@
+import asyncio
+import copy
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Optional
+
+from ayamytk.test.bench.models import (
+    AsyncSamplerBase,
+    MessageList,
+    SamplerBase,
+    SamplerResponse,
+)
+
+
+class HedgingPolicy:
+    """
+    Decides when a slow request deserves a duplicate.
+
+    Keeps a rolling window of request latencies and allows a hedge once a request
+    has run past the given percentile of that window, as long as hedges stay under
+    `max_hedge_fraction` of all requests.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 95.0,
+        window: int = 200,
+        min_samples: int = 20,
+        max_hedge_fraction: float = 0.05,
+    ):
+        self.percentile = percentile
+        self.window = window
+        self.min_samples = min_samples
+        self.max_hedge_fraction = max_hedge_fraction
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+        self.lock = threading.Lock()
+
+    def fresh(self) -> "HedgingPolicy":
+        """
+        A policy with the same settings and no latency history.
+        """
+        return HedgingPolicy(
+            percentile=self.percentile,
+            window=self.window,
+            min_samples=self.min_samples,
+            max_hedge_fraction=self.max_hedge_fraction,
+        )
+
+    def delay(self) -> Optional[float]:
+        """
+        Seconds to wait before hedging a new request, or None to not hedge yet.
+        """
+        with self.lock:
+            self.requests += 1
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+        return latencies[index]
+
+    def allow_hedge(self) -> bool:
+        with self.lock:
+            if self.hedges + 1 > self.max_hedge_fraction * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def record(self, latency: float):
+        with self.lock:
+            self.latencies.append(latency)
+
+
+class HedgedSampler(SamplerBase):
+    """
+    Send a duplicate of any request that runs past a rolling latency percentile,
+    and return whichever reply arrives first.
+
+    The losing request of a synchronous sampler cannot be cancelled, so it still
+    runs to completion in the background; its cost is bounded by the policy's
+    `max_hedge_fraction`. Until the policy has enough latencies to hedge, requests
+    run directly on the calling thread. The thread pool used once hedging starts
+    is shared with copies made by `with_options`, and `close` shuts it down.
+    """
+
+    def __init__(
+        self,
+        sampler: SamplerBase,
+        policy: Optional[HedgingPolicy] = None,
+        max_workers: int = 100,
+        **policy_kwargs: Any,
+    ):
+        self.sampler = sampler
+        self.policy = policy or HedgingPolicy(**policy_kwargs)
+        # Starts no threads until the first request that may be hedged
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    @property
+    def provider(self):
+        return getattr(self.sampler, "provider", None)
+
+    def _pack_message(self, role, content):
+        return self.sampler._pack_message(role=role, content=content)
+
+    def with_options(self, **options: Any) -> "HedgedSampler":
+        hedged = copy.copy(self)
+        hedged.sampler = self.sampler.with_options(**options)
+        # Different settings have a different latency profile
+        hedged.policy = self.policy.fresh()
+        return hedged
+
+    def close(self):
+        """
+        Shut down the thread pool, letting requests still in flight finish.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    def _finish(self, response: SamplerResponse, start: float, hedged: bool):
+        latency = time.monotonic() - start
+        # Cache hits say nothing about how long the provider takes
+        if not (response.response_metadata or {}).get("cache_hit"):
+            self.policy.record(latency)
+        response.response_metadata = {
+            **(response.response_metadata or {}),
+            # Includes the wait before the hedge was sent
+            "latency": latency,
+            "hedged": hedged,
+        }
+        return response
+
+    def __call__(self, message_list: MessageList) -> SamplerResponse:
+        start = time.monotonic()
+        delay = self.policy.delay()
+        if delay is None:
+            return self._finish(self.sampler(message_list), start, False)
+        primary = self.executor.submit(self.sampler, message_list)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self.policy.allow_hedge():
+            return self._finish(primary.result(), start, False)
+        hedge = self.executor.submit(self.sampler, message_list)
+        done, _ = wait([primary, hedge], return_when=FIRST_COMPLETED)
+        winner = done.pop()
+        if winner.exception() is not None:
+            # Fall back to the other request if the first one to finish failed
+            winner = hedge if winner is primary else primary
+        return self._finish(winner.result(), start, True)
+
+
+class AsyncHedgedSampler(HedgedSampler, AsyncSamplerBase):
+    """
+    Hedge requests of an async sampler. The losing request is cancelled.
+    """
+
+    def __init__(
+        self,
+        sampler: AsyncSamplerBase,
+        policy: Optional[HedgingPolicy] = None,
+        **policy_kwargs: Any,
+    ):
+        self.sampler = sampler
+        self.policy = policy or HedgingPolicy(**policy_kwargs)
+        self.executor = None
+
+    def __call__(self, message_list: MessageList) -> SamplerResponse:
+        raise TypeError(f"{type(self).__name__} is asynchronous, use acall instead")
+
+    async def acall(self, message_list: MessageList) -> SamplerResponse:
+        start = time.monotonic()
+        delay = self.policy.delay()
+        primary = asyncio.ensure_future(self.sampler.acall(message_list))
+        if delay is None:
+            return self._finish(await primary, start, False)
+        done, _ = await asyncio.wait([primary], timeout=delay)
+        if done or not self.policy.allow_hedge():
+            return self._finish(await primary, start, False)
+        hedge = asyncio.ensure_future(self.sampler.acall(message_list))
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                succeeded = [task for task in done if task.exception() is None]
+                if succeeded:
+                    return self._finish(succeeded[0].result(), start, True)
+                if not pending:
+                    # Both failed, raise the error
+                    return self._finish(done.pop().result(), start, True)
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+def with_hedging(sampler: Any, **kwargs: Any) -> HedgedSampler:
+    """
+    Wrap a sync or async sampler in the matching hedging sampler.
+    """
+    if isinstance(sampler, AsyncSamplerBase):
+        return AsyncHedgedSampler(sampler, **kwargs)
+    return HedgedSampler(sampler, **kwargs)
@@ -0,0 +1,46 @@
+import time
+from typing import Any, Optional
+
+
+def usage_counts(usage: Any) -> tuple[Optional[int], Optional[int]]:
+    """
+    Prompt and completion tokens from an OpenAI or Cohere usage object, if reported.
+    """
+    if usage is None:
+        return None, None
+    if getattr(usage, "prompt_tokens", None) is not None:
+        return usage.prompt_tokens, getattr(usage, "completion_tokens", None)
+    tokens = getattr(usage, "tokens", None) or getattr(usage, "billed_units", None)
+    if tokens is not None:
+        return (
+            getattr(tokens, "input_tokens", None),
+            getattr(tokens, "output_tokens", None),
+        )
+    return None, None
+
+
+def request_metrics(
+    start: float,
+    retries: int,
+    usage: Any = None,
+    ttft: Optional[float] = None,
+) -> dict[str, Any]:
+    """
+    Response metadata describing how a request went.
+
+    `start` is the `time.monotonic()` at which the sampler was called, so the
+    latency includes rate limit waits and retries. `ttft` is the time from sending
+    the successful attempt to its first streamed token. Token counts estimated
+    from the text of a stream stopped early are flagged with `usage_estimated`.
+    """
+    metadata = {"latency": time.monotonic() - start, "retries": retries}
+    if ttft is not None:
+        metadata["ttft"] = ttft
+    prompt_tokens, completion_tokens = usage_counts(usage)
+    if prompt_tokens is not None:
+        metadata["prompt_tokens"] = prompt_tokens
+    if completion_tokens is not None:
+        metadata["completion_tokens"] = completion_tokens
+    if getattr(usage, "estimated", False):
+        metadata["usage_estimated"] = True
+    return metadata
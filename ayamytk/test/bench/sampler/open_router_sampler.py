@@ -1,7 +1,18 @@
-from ayamytk.test.bench.sampler.chat_completion_sampler import ChatCompletionSampler
+from ayamytk.test.bench.sampler.chat_completion_sampler import (
+    AsyncChatCompletionSampler,
+    ChatCompletionSampler,
+)
+
+OpenRouterSampler = lambda model, **kwargs: ChatCompletionSampler(
+    model=model,
+    base_url="https://openrouter.ai/api/v1",
+    api_key_name="OPENROUTER_API_KEY",
+    **kwargs,
+)
 
-OpenRouterSampler = lambda model: ChatCompletionSampler(
+AsyncOpenRouterSampler = lambda model, **kwargs: AsyncChatCompletionSampler(
     model=model,
     base_url="https://openrouter.ai/api/v1",
     api_key_name="OPENROUTER_API_KEY",
+    **kwargs,
 )
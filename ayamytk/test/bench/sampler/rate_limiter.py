@@ -0,0 +1,184 @@
+import asyncio
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from ayamytk.test.bench.models import MessageList
+
+
+class RateLimiter:
+    """
+    Token-bucket limiter enforcing requests-per-minute and tokens-per-minute
+    budgets for one provider.
+
+    A single instance is shared by every sampler talking to the same provider
+    (see `get_rate_limiter`), so threads and coroutines draw from one budget and
+    back off together when the provider reports a rate limit, instead of each
+    sleeping on its own schedule and retrying in lockstep.
+    """
+
+    def __init__(self, rpm: Optional[float] = None, tpm: Optional[float] = None):
+        self.lock = threading.Lock()
+        self.rpm = rpm
+        self.tpm = tpm
+        self.request_tokens = float(rpm or 0)
+        self.token_tokens = float(tpm or 0)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+
+    def configure(self, rpm: Optional[float] = None, tpm: Optional[float] = None):
+        with self.lock:
+            if rpm is not None:
+                self.request_tokens = (
+                    min(self.request_tokens, rpm) if self.rpm else float(rpm)
+                )
+                self.rpm = rpm
+            if tpm is not None:
+                self.token_tokens = (
+                    min(self.token_tokens, tpm) if self.tpm else float(tpm)
+                )
+                self.tpm = tpm
+
+    def _refill(self, now: float):
+        if now <= self.updated_at:
+            return
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        if self.rpm:
+            self.request_tokens = min(
+                self.rpm, self.request_tokens + elapsed * self.rpm / 60
+            )
+        if self.tpm:
+            self.token_tokens = min(
+                self.tpm, self.token_tokens + elapsed * self.tpm / 60
+            )
+
+    def _try_acquire(self, tokens: int) -> float:
+        """
+        Take one request and `tokens` tokens from the buckets if available.
+        Returns 0 on success, otherwise the number of seconds to wait.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            wait = 0.0
+            if self.rpm and self.request_tokens < 1:
+                wait = max(wait, (1 - self.request_tokens) * 60 / self.rpm)
+            if self.tpm:
+                # A request larger than the whole budget waits for a full bucket
+                tokens = min(tokens, self.tpm)
+                if self.token_tokens < tokens:
+                    wait = max(wait, (tokens - self.token_tokens) * 60 / self.tpm)
+            if wait > 0:
+                return wait
+            if self.rpm:
+                self.request_tokens -= 1
+            if self.tpm:
+                self.token_tokens -= tokens
+            return 0.0
+
+    def acquire(self, tokens: int = 0):
+        while (wait := self._try_acquire(tokens)) > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: int = 0):
+        while (wait := self._try_acquire(tokens)) > 0:
+            await asyncio.sleep(wait)
+
+    def settle(self, estimated_tokens: int, actual_tokens: Optional[int]):
+        """
+        Correct the token bucket once the real usage of a request is known.
+        """
+        if not self.tpm or actual_tokens is None:
+            return
+        with self.lock:
+            self.token_tokens = min(
+                self.tpm, self.token_tokens + estimated_tokens - actual_tokens
+            )
+
+    def backoff(self, seconds: float):
+        """
+        Pause every caller of this limiter after the provider reported a rate
+        limit, and drain the buckets so traffic resumes at the refill rate.
+        """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.request_tokens = 0.0
+            self.token_tokens = 0.0
+            # Start refilling only once the pause is over
+            self.updated_at = self.blocked_until
+
+
+_rate_limiters: dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(
+    key: str, rpm: Optional[float] = None, tpm: Optional[float] = None
+) -> RateLimiter:
+    """
+    Return the process-wide limiter for a provider (or base_url), creating it on
+    first use. Limits passed here override those previously set for the key.
+    """
+    with _rate_limiters_lock:
+        if key not in _rate_limiters:
+            _rate_limiters[key] = RateLimiter()
+        limiter = _rate_limiters[key]
+    limiter.configure(rpm=rpm, tpm=tpm)
+    return limiter
+
+
+def estimate_tokens(message_list: MessageList, max_tokens: int = 0) -> int:
+    """
+    Rough upper estimate of the tokens a request will use, reserved up front and
+    corrected by `RateLimiter.settle` once the usage is known.
+    """
+    chars = sum(len(str(m.get("content", ""))) for m in message_list)
+    return chars // 3 + max_tokens
+
+
+@dataclass
+class EstimatedUsage:
+    """
+    Usage of a streamed response that was closed before the provider reported
+    its usage, estimated from the text like `estimate_tokens`.
+    """
+
+    prompt_tokens: int
+    completion_tokens: int
+    estimated: bool = True
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+def estimate_usage(message_list: MessageList, content: str) -> EstimatedUsage:
+    return EstimatedUsage(
+        prompt_tokens=estimate_tokens(message_list), completion_tokens=len(content) // 3
+    )
+
+
+def usage_tokens(usage: Any) -> Optional[int]:
+    """
+    Total tokens from an OpenAI or Cohere usage object, if reported.
+    """
+    if usage is None:
+        return None
+    total = getattr(usage, "total_tokens", None)
+    if total is not None:
+        return total
+    tokens = getattr(usage, "tokens", None) or getattr(usage, "billed_units", None)
+    if tokens is not None:
+        return int(
+            (getattr(tokens, "input_tokens", None) or 0)
+            + (getattr(tokens, "output_tokens", None) or 0)
+        )
+    return None
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    return getattr(e, "status_code", None) == 429 or "limit" in str(e).lower()
@@ -0,0 +1,107 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Optional, Union
+
+from ayamytk.test.bench.models import (
+    AsyncSamplerBase,
+    MessageList,
+    SamplerBase,
+    SamplerResponse,
+    as_async_sampler,
+)
+
+
+def provider_of(sampler: Union[SamplerBase, AsyncSamplerBase]) -> str:
+    """
+    Name of the provider (or base_url) a sampler sends its requests to.
+    """
+    return getattr(sampler, "provider", None) or type(sampler).__name__
+
+
+class ProviderLimitedSampler(AsyncSamplerBase):
+    """
+    Async sampler that holds a slot of its provider's semaphore while a request
+    is in flight.
+    """
+
+    def __init__(self, sampler: AsyncSamplerBase, semaphore: asyncio.Semaphore):
+        self.sampler = sampler
+        self.semaphore = semaphore
+
+    def _pack_message(self, role, content):
+        return self.sampler._pack_message(role=role, content=content)
+
+    def with_options(self, **options: Any) -> "ProviderLimitedSampler":
+        return ProviderLimitedSampler(
+            self.sampler.with_options(**options), self.semaphore
+        )
+
+    async def acall(self, message_list: MessageList) -> SamplerResponse:
+        async with self.semaphore:
+            return await self.sampler.acall(message_list)
+
+
+class Scheduler:
+    """
+    Run many (model, eval) jobs at once from a single event loop.
+
+    Synchronous samplers are driven through a thread pool of `max_workers`
+    threads shared by every job, which is the global worker budget. Each provider
+    is additionally capped at `provider_concurrency[provider]` in-flight requests
+    (`default_provider_concurrency` when unlisted), so traffic to different
+    providers overlaps while each one stays within its own limits.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 200,
+        provider_concurrency: Optional[dict[str, int]] = None,
+        default_provider_concurrency: int = 50,
+    ):
+        self.max_workers = max_workers
+        self.provider_concurrency = provider_concurrency or {}
+        self.default_provider_concurrency = default_provider_concurrency
+        self.semaphores: dict[str, asyncio.Semaphore] = {}
+
+    def limit(self, sampler: Union[SamplerBase, AsyncSamplerBase]) -> AsyncSamplerBase:
+        """
+        Wrap a sampler so that its requests count against its provider's cap.
+        Must be called from within a running job.
+        """
+        provider = provider_of(sampler)
+        if provider not in self.semaphores:
+            self.semaphores[provider] = asyncio.Semaphore(
+                self.provider_concurrency.get(
+                    provider, self.default_provider_concurrency
+                )
+            )
+        return ProviderLimitedSampler(
+            as_async_sampler(sampler), self.semaphores[provider]
+        )
+
+    def run(self, jobs: list[Callable[[], Awaitable[Any]]]) -> list[Any]:
+        """
+        Run every job concurrently and return their results (or the exception
+        a job raised) in the order given.
+        """
+        from ayamytk.test.bench.sampler.clients import aclose_clients
+
+        self.semaphores = {}
+
+        async def main():
+            try:
+                return await asyncio.gather(
+                    *(job() for job in jobs), return_exceptions=True
+                )
+            finally:
+                # Async clients cannot be reused once this loop is closed
+                await aclose_clients()
+
+        loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        loop.set_default_executor(executor)
+        try:
+            return loop.run_until_complete(main())
+        finally:
+            loop.close()
+            executor.shutdown(wait=False)
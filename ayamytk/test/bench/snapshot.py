@@ -0,0 +1,132 @@
+"""
+Offline snapshots of the benchmark datasets.
+
+    python -m ayamytk.test.bench.snapshot ./snapshots/2025-06
+
+exports every benchmark to an Arrow file with a checksummed manifest, which
+`evals.run(snapshot=...)` (or `--snapshot`) then loads without any network calls.
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+from typing import Optional
+
+import pyarrow as pa
+from datasets import Dataset, load_dataset
+
+SNAPSHOT_FORMAT_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+# Eval name -> Hugging Face dataset the eval is built from
+BENCHMARK_DATASETS = {
+    "mmlu_lite": "Rickaym/Burmese-MMLU-Lite",
+    "mg12l": "Rickaym/Myanmar-G12L-Benchmark",
+}
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def export_snapshot(
+    directory: str,
+    names: Optional[list[str]] = None,
+    split: str = "test",
+    version: Optional[str] = None,
+) -> dict:
+    """
+    Download the benchmark datasets and write them, in their original row order,
+    to Arrow files in `directory` along with a manifest of their checksums.
+
+    Examples are sampled and filtered from row indices with a fixed seed, so a
+    snapshot selects exactly the same examples as the hub dataset it came from.
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "version": version or datetime.date.today().isoformat(),
+        "datasets": {},
+    }
+    for name in names or BENCHMARK_DATASETS:
+        repo = BENCHMARK_DATASETS[name]
+        dataset = load_dataset(repo, split=split)
+        filename = f"{name}.arrow"
+        path = os.path.join(directory, filename)
+        table = dataset.data.table
+        with pa.OSFile(path, "wb") as sink:
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+        manifest["datasets"][name] = {
+            "repo": repo,
+            "split": split,
+            "fingerprint": dataset._fingerprint,
+            "file": filename,
+            "num_rows": len(dataset),
+            "sha256": file_sha256(path),
+        }
+        print(f"Exported {repo} ({len(dataset)} rows) to {path}")
+    with open(os.path.join(directory, MANIFEST_NAME), "w", encoding="utf-8") as fh:
+        json.dump(manifest, fh, indent=2)
+    return manifest
+
+
+def load_snapshot(directory: str, name: str, verify: bool = True):
+    """
+    Memory-map one benchmark of a snapshot as a `datasets.Dataset`, checking it
+    against the manifest first.
+    """
+    with open(os.path.join(directory, MANIFEST_NAME), "r", encoding="utf-8") as fh:
+        manifest = json.load(fh)
+    if manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+        raise SnapshotError(
+            f"Unsupported snapshot format {manifest.get('format_version')} in {directory}"
+        )
+    if name not in manifest["datasets"]:
+        raise SnapshotError(f"Snapshot {directory} has no {name} dataset")
+    entry = manifest["datasets"][name]
+    path = os.path.join(directory, entry["file"])
+    if verify and file_sha256(path) != entry["sha256"]:
+        raise SnapshotError(f"Checksum mismatch for {path}")
+    dataset = Dataset.from_file(path)
+    if len(dataset) != entry["num_rows"]:
+        raise SnapshotError(
+            f"{path} has {len(dataset)} rows, the manifest says {entry['num_rows']}"
+        )
+    return dataset
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export the benchmark datasets to an offline snapshot."
+    )
+    parser.add_argument("directory", type=str, help="Directory to write the snapshot to")
+    parser.add_argument(
+        "--evals",
+        "-e",
+        type=str,
+        help="Comma-separated list of benchmarks to export (default: all)",
+        default=None,
+    )
+    parser.add_argument(
+        "--version", type=str, help="Snapshot version label (default: today's date)"
+    )
+    args = parser.parse_args()
+    export_snapshot(
+        args.directory,
+        names=args.evals.split(",") if args.evals else None,
+        version=args.version,
+    )
+
+
+if __name__ == "__main__":
+    main()